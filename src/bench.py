@@ -0,0 +1,490 @@
+#!/usr/bin/env python2.4
+
+from pylog import *
+
+import resource
+import sys
+import time
+
+def timeit(name, f, *args):
+    t0 = time.time()
+    f(*args)
+    print "\t%-24s %8.3f s"%(name, time.time()-t0)
+
+def stacks(n=400, repeat=10):
+    """ Deep conjunctions: each goal dereferences the first variable """
+    xs = [Var() for i in range(n)]
+    goal = Unify(xs[0], 0)
+    for i, x in enumerate(xs[1:]):
+        goal = goal & Unify(x, i+1) & IsInteger(xs[0])
+    def run(s):
+        for i in range(repeat):
+            for _ in goal(s):
+                pass
+    print "%d goals deep conjunction (x%d)"%(2*n, repeat)
+    limit = Stack.squash_limit
+    Stack.squash_limit = 0
+    timeit("Stack (no squash)", run, Stack())
+    Stack.squash_limit = limit
+    for stack in (Stack, TrailStack, HamtStack):
+        timeit(stack.__name__, run, stack())
+
+class _OldTerm:
+    """ Term representation without slots (args list, functor and arity in a __dict__) """
+    def __init__(self, *args):
+        self.args = list(args)
+        self.functor = self.__class__
+        self.arity = len(args)
+
+def memory():
+    """ Memory used by a cons cell """
+    def size(t):
+        n = sys.getsizeof(t) + sys.getsizeof(t.args)
+        try:
+            n += sys.getsizeof(t.__dict__)
+        except AttributeError:
+            pass
+        return n
+    print "bytes per cons cell"
+    print "\t%-24s %8d"%("__dict__", size(_OldTerm(1, None)))
+    print "\t%-24s %8d"%("__slots__", size(cons(1, nil)))
+
+def answers(n=10000, repeat=100):
+    """ Copy of answers made of a large ground term and a few variables """
+    class likes(Term): pass
+    X = Var()
+    facts = nil
+    for i in xrange(n):
+        facts = cons(likes('sam', i), facts)
+    answer = likes(X, facts)
+    s = Stack().unify(X, 'sam').next()
+    def run():
+        for i in xrange(repeat):
+            s(answer)
+    print "answer with a %d facts list (x%d)"%(n, repeat)
+    timeit("Stack.__call__", run)
+
+def lists(sizes=(10**5, 10**6)):
+    """ Unification, copy, comparison and printing of long lists """
+    for n in sizes:
+        X = Var()
+        l1 = nil
+        for i in xrange(n-1, -1, -1):
+            l1 = cons(i, l1)
+        l2 = X
+        for i in xrange(n-1, -1, -1):
+            l2 = cons(i, l2)
+        s = Stack()
+        print "%d elements lists"%n
+        timeit("unify", lambda: s.unify(l1, l2).next())
+        s = s.unify(l1, l2).next()
+        timeit("copy", s, l2)
+        timeit("compare", lambda: Eq(l1, l2)(s).next())
+        timeit("str", l1.__str__, n+1)
+
+def sharing(n=10**5, m=100):
+    """ Bulk loading of ground facts with m distinct subterms, shared by
+    canonical, and comparison of identical subterms """
+    class point(Term): pass
+    class fact(Term): pass
+    facts = [fact(i, point(i % m, 'x')) for i in xrange(n)]
+    loaded = []
+    def load():
+        for t in facts:
+            loaded.append(canonical(t))
+    print "%d facts, %d distinct subterms"%(n, m)
+    timeit("canonical", load)
+    print "\t%-24s %8d"%("distinct subterms", len(set([id(t.args[1]) for t in loaded])))
+    def compare(ts):
+        s = Stack()
+        for i in xrange(m, len(ts)):
+            for s1 in Eq(ts[i-m].args[1], ts[i].args[1])(s):
+                pass
+    timeit("Eq (copies)", compare, facts)
+    timeit("Eq (shared)", compare, loaded)
+
+def aliases(n=300, repeat=5):
+    """ Dereferencing a chain of aliased variables (X0=X1, X1=X2, ...) """
+    xs = [Var() for i in range(n)]
+    def run(s):
+        for i in xrange(n-1):
+            s = s.unify(xs[i], xs[i+1]).next()
+        for i in xrange(repeat):
+            for x in xs:
+                s[x]
+    print "%d aliased variables, dereferenced %d times"%(n, repeat)
+    for stack in (Stack, TrailStack, HamtStack):
+        timeit(stack.__name__, run, stack())
+
+def occurs(n=1000):
+    """ Unification with occurs check binding n variables to the same large term """
+    Y = Var()
+    t = Y
+    for i in xrange(n):
+        t = cons(i, t)
+    xs = nil
+    ts = nil
+    for i in xrange(n):
+        xs = cons(Var(), xs)
+        ts = cons(t, ts)
+    print "%d variables bound to a %d elements list"%(n, n)
+    for stack in (Stack, TrailStack, HamtStack):
+        timeit(stack.__name__, lambda: stack().unify_with_occurs_check(xs, ts).next())
+
+def unify(n=10000, repeat=10):
+    """ Unification and comparison of lists of mixed compound and atomic terms """
+    class f(Term): pass
+    l1 = nil
+    l2 = nil
+    l3 = nil
+    for i in xrange(n):
+        X = Var()
+        l1 = cons(f(i, 'a', 1.5, f(X)), l1)
+        l2 = cons(f(i, 'a', 1.5, Var()), l2)
+        l3 = cons(f(i, 'a', 1.5, f(X)), l3)
+    def run_unify():
+        for i in xrange(repeat):
+            Stack().unify(l1, l2).next()
+    def run_compare():
+        for i in xrange(repeat):
+            l1.cmp(l3, Stack())
+    print "%d elements lists (x%d)"%(n, repeat)
+    timeit("unify", run_unify)
+    timeit("compare", run_compare)
+
+def sorting(n=10**5):
+    """ Sorting a list of mixed atomic and compound terms """
+    import random
+    class f(Term): pass
+    items = [random.choice([random.random(), random.randint(0, n), str(random.randint(0, n)),
+                            f(random.randint(0, n), 'a')]) for i in xrange(n)]
+    l = nil
+    for t in items:
+        l = cons(t, l)
+    S = Var()
+    print "%d elements list"%n
+    timeit("Sort", lambda: Sort(l, S)(Stack()).next())
+    timeit("MSort", lambda: MSort(l, S)(Stack()).next())
+    timeit("Sort (descending)", lambda: Sort(0, Ge, l, S)(Stack()).next())
+
+def packed(n=10**6):
+    """ Long lists of integers as cons cells and as packed lists, ground
+    or ending with a variable """
+    def cons_list(tail):
+        l = tail
+        for i in xrange(n-1, -1, -1):
+            l = cons(i, l)
+        return l
+    def packed_list(tail):
+        return plist(xrange(n), tail)
+    print "%d elements lists"%n
+    for name, make in (("cons", cons_list), ("plist", packed_list)):
+        t0 = time.time()
+        l1 = make(nil)
+        X = Var()
+        l2 = make(X)
+        print "\t%-24s %8.3f s"%(name+" build", time.time()-t0)
+        s = Stack()
+        timeit(name+" unify", lambda: s.unify(l1, l2).next())
+        s = s.unify(l1, l2).next()
+        timeit(name+" copy", s, l2)
+        timeit(name+" compare", lambda: l1.cmp(l2, s))
+        l3 = make(nil)
+        timeit(name+" Eq (ground)", lambda: Eq(l1, l3)(s).next())
+        timeit(name+" acyclic", lambda: IsAcyclic(l2)(Stack()).next())
+        timeit(name+" from_term", from_term, l2)
+
+def convert(n=10**6):
+    """ Conversion between Python lists and terms """
+    flat = range(n)
+    nested = [[i, str(i)] for i in xrange(n/10)]
+    X = Var()
+    print "%d elements lists"%n
+    timeit("to_term", to_term, flat)
+    timeit("to_term (nested)", to_term, nested)
+    t = to_term(flat)
+    timeit("from_term", from_term, t)
+    s = Stack().unify(X, t).next()
+    timeit("from_term (stack)", from_term, cons(X, nil), s)
+    timeit("from_term (copy)", lambda: from_term(s(cons(X, nil))))
+
+def writing(n=10**6):
+    """ Writing a long list of compound terms """
+    import cStringIO
+    class f(Term): pass
+    X = Var()
+    l = to_term([f(i, 'a b') for i in xrange(n-1)] + [X])
+    s = Stack().unify(X, 'x').next()
+    print "%d elements list"%n
+    timeit("str", l.__str__, n+1)
+    timeit("write_term", write_term, l, cStringIO.StringIO())
+    timeit("write_term (stack)", write_term, l, cStringIO.StringIO(), s)
+
+def indexing(n=500):
+    """ Calls of fact tables with a bound argument """
+    class square(Predicate): pass
+    class point(Term): pass
+    class label(Predicate): pass
+    for i in xrange(n):
+        square.assertz(square(i, i*i))
+        label.assertz(label(point(i % 10, i), i))
+    X = Var()
+    def run(goals):
+        for goal in goals:
+            for s in goal(Stack()):
+                pass
+    queries = [
+        ("first argument", [square(i, X) for i in xrange(n)]),
+        ("second argument", [square(X, i*i) for i in xrange(n)]),
+        ("nested argument", [label(point(X, i), X) for i in xrange(n)]),
+    ]
+    print "%d facts, %d calls"%(n, n)
+    for name, goals in queries:
+        Predicate.indexing = False
+        timeit(name+" (scan)", run, goals)
+        Predicate.indexing = True
+        timeit(name+" (index)", run, goals)
+    for stats in square.index_stats() + label.index_stats():
+        print "\t%(argument)-14s %(clauses)6d clauses %(keys)6d keys %(calls)6d calls"%stats,
+        if stats['calls']:
+            print "%(clauses per call)6.1f clauses per call"%stats
+        else:
+            print
+
+def cuts(n=300, repeat=20):
+    """ shorten/2 (examples/path.py): removes consecutive duplicates with cuts """
+    class shorten(Predicate): pass
+    X, L0, L1 = Var(), Var(), Var()
+    shorten.assertz(shorten(nil, nil))
+    shorten.assertz(shorten(cons(X, nil), cons(X, nil)), cut)
+    shorten.assertz(shorten(cons(X, cons(X, L0)), L1), cut & shorten(cons(X, L0), L1))
+    shorten.assertz(shorten(cons(X, L0), cons(X, L1)), shorten(L0, L1))
+    l = to_term([i/3 for i in xrange(n)])
+    R = Var()
+    def run():
+        for i in xrange(repeat):
+            for s in shorten(l, R)(Stack()):
+                pass
+    print "shorten/2 of a %d elements list (x%d)"%(n, repeat)
+    timeit("shorten", run)
+
+def solver(n=500, repeat=20, deep=10**5):
+    """ Nested generators against the continuation based solver (Solve) """
+    class app(Predicate): pass
+    H, T, L, L2, R = Var(), Var(), Var(), Var(), Var()
+    app.assertz(app(nil, L, L))
+    app.assertz(app(cons(H, T), L2, cons(H, R)), app(T, L2, R))
+    A, B = Var(), Var()
+    l = to_term(range(n))
+    def run(solve):
+        for i in xrange(repeat):
+            for s in solve(app(A, B, l))(Stack()):
+                pass
+    print "app(A, B, L) with a %d elements list, all solutions (x%d)"%(n, repeat)
+    timeit("generators", run, lambda goal: goal)
+    timeit("Solve", run, Solve)
+    print "app(L, [0], A) with a %d elements list"%deep
+    l = to_term(range(deep))
+    timeit("Solve", lambda: Solve(app(l, to_term([0]), A))(TrailStack()).next())
+
+def tail(n=10**6):
+    """ Counting loop by a tail recursive predicate (last call optimization) """
+    class count(Predicate): pass
+    N, N1, Max = Var(), Var(), Var()
+    count.assertz(count(N, Max), IfThenElse(Lt(N, Max), Succ(N, N1) & count(N1, Max), true))
+    def run(m):
+        r0 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        t0 = time.time()
+        Solve(count(0, m))(TrailStack()).next()
+        r1 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        print "\t%-24s %8.3f s %8d kB"%("count to %d"%m, time.time()-t0, r1-r0)
+    print "count(0, N) on a TrailStack, time and memory growth"
+    run(n)
+    compaction = Solve.compaction
+    Solve.compaction = 0
+    print "without compaction of the bindings"
+    run(n/10)
+    Solve.compaction = compaction
+
+class _BinaryAnd(Term2):
+    """ Binary conjunction (a generator per conjunction) """
+    def __call__(self, s):
+        for s0 in self.args[0](s):
+            for s1 in self.args[1](s0):
+                yield s1
+
+def conjunctions(k=12, n=30, m=200, repeat=5):
+    """ Conjunctions of n goals: k binary choices followed by type checks
+    of the variables, then of constants, then a long body of m goals
+    with k-4 choices (the cost of the conjunction) """
+    for checks in ("variables", "constants", "constants, long body"):
+        if checks.endswith("long body"):
+            k, n = k-4, m
+        xs = [Var() for i in xrange(k)]
+        goals = [Unify(x, 0) | Unify(x, 1) for x in xs]
+        if checks == "variables":
+            goals += [IsInteger(xs[i % k]) for i in xrange(n-k)]
+        else:
+            goals += [IsInteger(i) for i in xrange(n-k)]
+        binary = goals[0]
+        for g in goals[1:]:
+            binary = _BinaryAnd(binary, g)
+        flat = And(*goals)
+        def run(goal):
+            for i in xrange(repeat):
+                for s in goal(Stack()):
+                    pass
+        print "%d goals, %d solutions, type checks of %s (x%d)"%(n, 2**k, checks, repeat)
+        timeit("binary And", run, binary)
+        timeit("n-ary And", run, flat)
+        timeit("Solve", run, Solve(flat))
+
+def compiled(n=2000, width=4, depth=5, repeat=10):
+    """ likes and path (examples/likes.py, examples/path.py) scaled up,
+    interpreted and compiled into closures """
+    class indian(Predicate): pass
+    class mild(Predicate): pass
+    class chinese(Predicate): pass
+    class italian(Predicate): pass
+    class likes(Predicate): pass
+    class next(Predicate): pass
+    class path(Predicate): pass
+    Food, X, Y, Z, P = Var(), Var(), Var(), Var(), Var()
+    for i in xrange(n):
+        indian.assertz(indian('indian%d'%i))
+        if i % 2:
+            mild.assertz(mild('indian%d'%i))
+        chinese.assertz(chinese('chinese%d'%i))
+        italian.assertz(italian('italian%d'%i))
+    likes.assertz(likes('sam', Food), indian(Food) & mild(Food) & IsString(Food))
+    likes.assertz(likes('sam', Food), chinese(Food) & Not(Eq(Food, 'chop_suey')))
+    likes.assertz(likes('sam', Food), italian(Food))
+    likes.assertz(likes('sam', 'chips'))
+    # layered graph: width nodes per layer, each linked to the next layer
+    for layer in xrange(depth):
+        for i in xrange(width):
+            for j in xrange(width):
+                next.assertz(next((layer, i), (layer+1, j)))
+    path.assertz(path(X, Y, cons(X, cons(Y, nil))), next(X, Y))
+    path.assertz(path(X, Y, cons(X, P)), next(X, Z) & IfThenElse(IsNonVar(Z), path(Z, Y, P), fail))
+    W = Var()
+    queries = [
+        ("likes", likes('sam', W)),
+        ("path", path((0, 0), (depth, 0), W)),
+    ]
+    def run(goal):
+        for i in xrange(repeat):
+            for s in goal(Stack()):
+                pass
+    print "%d foods, %d paths (x%d)"%(n, width**(depth-1), repeat)
+    for name, query in queries:
+        for compiled in (False, True):
+            Predicate.compiled = compiled
+            if compiled:
+                timeit(name+" (compiled)", run, compile_goal(query))
+                timeit(name+" (Solve compiled)", run, Solve(query))
+            else:
+                timeit(name, run, query)
+                timeit(name+" (Solve)", run, Solve(query))
+    Predicate.compiled = False
+
+def wam(n=30, repeat=20, width=4, depth=5):
+    """ nrev and path solved by the generators, Solve, the compiled
+    clauses and the bytecode machine """
+    class app(Predicate): pass
+    class nrev(Predicate): pass
+    class next(Predicate): pass
+    class path(Predicate): pass
+    H, T, L, L2, R, R1 = Var(), Var(), Var(), Var(), Var(), Var()
+    X, Y, Z, P = Var(), Var(), Var(), Var()
+    app.assertz(app(nil, L, L))
+    app.assertz(app(cons(H, T), L2, cons(H, R)), app(T, L2, R))
+    nrev.assertz(nrev(nil, nil))
+    nrev.assertz(nrev(cons(H, T), R), nrev(T, R1) & app(R1, cons(H, nil), R))
+    for layer in xrange(depth):
+        for i in xrange(width):
+            for j in xrange(width):
+                next.assertz(next((layer, i), (layer+1, j)))
+    path.assertz(path(X, Y, cons(X, cons(Y, nil))), next(X, Y))
+    path.assertz(path(X, Y, cons(X, P)), next(X, Z) & path(Z, Y, P))
+    W = Var()
+    queries = [
+        ("nrev", nrev(to_term(range(n)), W)),
+        ("path", path((0, 0), (depth, 0), W)),
+    ]
+    def run(goal):
+        for i in xrange(repeat):
+            for s in goal(Stack()):
+                pass
+    print "nrev of %d elements, %d paths (x%d)"%(n, width**(depth-1), repeat)
+    for name, query in queries:
+        timeit(name, run, query)
+        timeit(name+" (Solve)", run, Solve(query))
+        Predicate.compiled = True
+        timeit(name+" (compiled)", run, compile_goal(query))
+        Predicate.compiled = False
+        timeit(name+" (Wam)", run, Wam(query))
+
+def loading(sizes=(10**4, 4*10**4, 8*10**4)):
+    """ Bulk loading of facts by assertz, with an index built first, and
+    alternating calls and assertz (as a memo table does) """
+    for n in sizes:
+        class fact(Predicate): pass
+        X = Var()
+        fact.assertz(fact(-1, -1))
+        fact.assertz(fact(-2, -2))
+        for s in fact(-1, X)(Stack()):
+            pass
+        def run():
+            for i in xrange(n):
+                fact.assertz(fact(i, i))
+        timeit("assertz x %d"%n, run)
+    for n in sizes:
+        class memo(Predicate): pass
+        X = Var()
+        memo.assertz(memo(-1, -1))
+        def run():
+            for i in xrange(n):
+                for s in memo(X, i-1)(Stack()):
+                    pass
+                memo.assertz(memo(i, i))
+        timeit("call, assertz x %d"%n, run)
+    for n in sizes:
+        class rule(Predicate): pass
+        X, Y = Var(), Var()
+        for i in xrange(n/2):
+            rule.assertz(rule(i, 'k'))
+        for s in rule(0, Y)(Stack()):
+            pass
+        def run():
+            for i in xrange(n/2):
+                rule.assertz(rule(X, i))
+        timeit("assertz x %d (var)"%(n/2), run)
+
+benchmarks = {
+    'aliases': aliases,
+    'indexing': indexing,
+    'lists': lists,
+    'loading': loading,
+    'answers': answers,
+    'compiled': compiled,
+    'conjunctions': conjunctions,
+    'convert': convert,
+    'cuts': cuts,
+    'memory': memory,
+    'occurs': occurs,
+    'packed': packed,
+    'solver': solver,
+    'sorting': sorting,
+    'sharing': sharing,
+    'stacks': stacks,
+    'tail': tail,
+    'unify': unify,
+    'wam': wam,
+    'writing': writing,
+}
+
+if __name__ == '__main__':
+    sys.setrecursionlimit(10000)
+    for name in sys.argv[1:] or sorted(benchmarks):
+        benchmarks[name]()
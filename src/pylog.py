@@ -18,8 +18,10 @@
 __version__ = "3.0-dev"
 
 import copy
-from itertools import izip
+from itertools import chain, islice, izip
 import math
+import re
+import weakref
 
 ###########################################################
 #
@@ -27,25 +29,101 @@ import math
 #
 ###########################################################
 
-class Term:
+# Type tags
+#
+# Unification and comparison dispatch on the pair of the type tags of
+# their arguments (see _unify_table and _compare_table) instead of
+# testing isinstance on every node. Term subclasses are registered by
+# their metaclass, other types are _OTHER.
+
+_VAR, _COMPOUND, _STR, _INT, _FLOAT, _OTHER, _PACKED = range(7)
+
+_tag = {
+    str: _STR, unicode: _STR,
+    int: _INT, long: _INT, bool: _INT,
+    float: _FLOAT,
+}
+
+class _TermMeta(type):
+    """ Metaclass of terms
+
+    Term subclasses get an empty __slots__ unless they define their
+    own, so that user-defined functors (class f(Term): pass) have no
+    per-instance __dict__. The functor of a term is its class.
+    """
+
+    def __new__(meta, name, bases, attrs):
+        attrs.setdefault('__slots__', ())
+        return type.__new__(meta, name, bases, attrs)
+
+    def __init__(cls, name, bases, attrs):
+        type.__init__(cls, name, bases, attrs)
+        cls.functor = cls
+        # terms of simple classes have no slot other than those of Term
+        cls._simple = not attrs['__slots__']
+        for base in bases:
+            cls._simple = cls._simple and getattr(base, '_simple', True)
+        for base in cls.__mro__[1:]:
+            if base in _tag:
+                _tag[cls] = _tag[base]
+                break
+        else:
+            _tag[cls] = _COMPOUND
+
+class Term(object):
     """ Base class for terms, variables, predicates, ...
+
+    The arguments of a term are stored in a tuple. Subclasses needing
+    more attributes shall declare them in __slots__.
+
+    A structural hash is computed when the term is built. It is None
+    if the term contains variables, so it also tells whether the term
+    is ground.
+
+    Goals that have at most one solution set deterministic so that
+    Solve runs them without leaving a choice point.
     """
 
+    __metaclass__ = _TermMeta
+    __slots__ = ('args', '_hash', '__weakref__')
+
+    deterministic = False
+
     def __init__(self, *args):
-        self.args = list(args)
-        self.functor = self.__class__
-        self.arity = len(args)
+        self.args = args
+        self._hash = _structural_hash(self.__class__, args)
+
+    def arity(self):
+        return len(self.args)
+    arity = property(arity)
+
+    def ground(self):
+        """ True if the term contains no variable """
+        return self._hash is not None
+    ground = property(ground)
 
     def __str__(self, L=10):
-        if L < 0: return '...'
-        args = []
-        for arg in self.args:
-            if isinstance(arg, Term):
-                arg = arg.__str__(L-1)
+        out = []
+        todo = [(self, L)]
+        while todo:
+            t, L = todo.pop()
+            if L is None:
+                out.append(t)
+            elif not isinstance(t, Term):
+                out.append(str(t))
+            elif L < 0:
+                out.append('...')
+            elif t.__class__.__str__ != Term.__str__:
+                out.append(t.__str__(L))
             else:
-                arg = str(arg)
-            args.append(arg)
-        return "%s(%s)"%(self.functor.__name__, ','.join(args))
+                todo.append((')', None))
+                args = t.args
+                for i in xrange(len(args)-1, -1, -1):
+                    todo.append((args[i], L-1))
+                    if i: todo.append((',', None))
+                out.append(t.functor.__name__)
+                out.append('(')
+        return ''.join(out)
 
     def __hash__(self):
         return id(self)
@@ -63,60 +141,376 @@ class Term:
     def __iter__(self): return self(Stack())
 
     def copy(self, s, memo):
-        try:
-            obj = memo[id(self)]
-        except KeyError:
-            obj = copy.copy(self)
-            memo[id(self)] = obj
-            memo[id(obj)] = obj
-            obj.rebuild(s, memo)
-        return obj
-
-    def rebuild(self, s, memo):
-        args = []
-        for arg in self.args:
-            if isinstance(arg, Term):
-                arg = arg.copy(s, memo)
-            args.append(arg)
-        self.args = args
+        """ Copy of the term where bound variables are replaced by their values
+
+        Subterms that contain no bound variables are not copied but
+        shared with the original term. memo maps the ids of the terms
+        already copied to their copies (cyclic terms are copied as
+        cyclic Python objects).
+        """
+        return _copy(self, s, memo)
 
     def cmp(self, other, s):
-        if isinstance(other, Term) and not isinstance(other, Var):
-            o = cmp(self.arity, other.arity) or cmp(self.functor.__name__, other.functor.__name__)
+        return _compare(self, other, s)
+
+Term._simple = True
+
+def _clone(t):
+    # Copy of t without arguments: the caller shall set args and _hash
+    # (or the items of a packed list)
+    if t._simple:
+        obj = object.__new__(t.__class__)
+    else:
+        obj = copy.copy(t)
+    obj._hash = None
+    return obj
+
+class _Cell(object):
+    """ Placeholder for a term being copied """
+    __slots__ = ('term',)
+    def __init__(self): self.term = None
+
+_nothing = object()
+
+def _copy(t, s, memo):
+    # Iterative copy (see Term.copy). stack contains the frames of the
+    # terms being copied ([term, cell, copied args, changed, args to
+    # copy]) and the
+    # ids of the bound variables waiting for the copy of their value.
+    stack = []
+    while True:
+        if not isinstance(t, Term):
+            value = t
+        elif isinstance(t, Var):
+            value = memo.get(id(t), _nothing)
+            if value is _nothing:
+                value = s[t]
+                if isinstance(value, Term) and value._hash is None and not isinstance(value, Var):
+                    stack.append(id(t))
+                    t = value
+                    continue
+                memo[id(t)] = value
+        elif t._hash is not None:
+            value = t
+        else:
+            value = memo.get(id(t), _nothing)
+            if value is _nothing:
+                cell = memo[id(t)] = _Cell()
+                if isinstance(t, plist):
+                    children = t.packed.items[t.start:] + (t.packed.tail,)
+                else:
+                    children = t.args
+                stack.append([t, cell, [], False, children])
+                t = children[0]
+                continue
+            if isinstance(value, _Cell):
+                # t is being copied: this is a cycle
+                if value.term is None:
+                    value.term = _clone(t)
+                value = value.term
+        while stack:
+            frame = stack[-1]
+            if type(frame) is int:
+                memo[frame] = value
+                stack.pop()
+                continue
+            node, cell, args, changed, children = frame
+            if value is not children[len(args)]:
+                frame[3] = True
+            args.append(value)
+            if len(args) < len(children):
+                t = children[len(args)]
+                break
+            stack.pop()
+            if frame[3]:
+                value = cell.term
+                if value is None:
+                    value = _clone(node)
+                if isinstance(node, plist):
+                    value._fill(args[:-1], args[-1])
+                    if cell.term is not None:
+                        # the copy closes a cycle: it is not ground
+                        value._h = None
+                else:
+                    value.args = tuple(args)
+                    value._hash = _structural_hash(value.functor, value.args)
+            else:
+                value = node
+            memo[id(node)] = value
+        else:
+            return value
+
+def _visited(seen, a, b):
+    """ True if the pair of compound terms (a, b) was already visited
+
+    Ground terms are built bottom-up and cannot be cyclic, so only pairs
+    with a non ground side are recorded: on rational trees the pair is
+    then assumed to hold (co-inductively) the second time it is met.
+    """
+    if a._hash is not None and b._hash is not None:
+        return False
+    key = (id(a), id(b))
+    if key in seen:
+        return True
+    seen.add(key)
+    return False
+
+# Actions of _compare: return -1 or +1, or compare the values, the
+# identities of the variables, the arguments of the terms or the items
+# of two packed lists.
+_LT, _GT, _VALUE, _IDS, _ARGS, _ITEMS = -1, +1, 0, 2, 3, 8
+
+# Standard order: Var < strings < numbers < other objects < compound terms
+_compare_table = [
+    #  Var    Compound   str      int      float    other    packed
+    [_IDS,   _LT,      _LT,     _LT,     _LT,     _LT,     _LT],       # Var
+    [_GT,    _ARGS,    _GT,     _GT,     _GT,     _GT,     _ARGS],     # Compound
+    [_GT,    _LT,      _VALUE,  _LT,     _LT,     _LT,     _LT],       # str
+    [_GT,    _LT,      _GT,     _VALUE,  _VALUE,  _LT,     _LT],       # int
+    [_GT,    _LT,      _GT,     _VALUE,  _VALUE,  _LT,     _LT],       # float
+    [_GT,    _LT,      _GT,     _GT,     _GT,     _VALUE,  _LT],       # other
+    [_GT,    _ARGS,    _GT,     _GT,     _GT,     _GT,     _ITEMS],    # packed
+]
+
+# Rank of each tag in the standard order (see sort_key)
+_rank = [0, 4, 1, 2, 2, 3, 4]
+
+def _visited_items(seen, a, b):
+    # _visited for packed lists: sublists are created on demand, so
+    # they are identified by their shared items and start index
+    if a._hash is not None and b._hash is not None:
+        return False
+    key = (id(a.packed), a.start, id(b.packed), b.start)
+    if key in seen:
+        return True
+    seen.add(key)
+    return False
+
+def _push_items(todo, a, b):
+    # pushes the pairs of items of the packed lists a and b and then
+    # the pair of their remaining sublists
+    items_a = a.packed.items
+    items_b = b.packed.items
+    i = a.start
+    j = b.start
+    n = min(len(items_a)-i, len(items_b)-j)
+    todo.append((a._sublist(i+n), b._sublist(j+n)))
+    if items_a is items_b and i == j:
+        return
+    for k in xrange(n-1, -1, -1):
+        x = items_a[i+k]
+        y = items_b[j+k]
+        if x is not y:
+            todo.append((x, y))
+
+def _compare(a, b, s):
+    # Iterative comparison in the standard order of terms
+    todo = [(a, b)]
+    seen = set()
+    tag = _tag.get
+    table = _compare_table
+    while todo:
+        a, b = todo.pop()
+        a = s[a]
+        b = s[b]
+        if a is b:
+            continue
+        o = table[tag(type(a), _OTHER)][tag(type(b), _OTHER)]
+        if o == _ARGS:
+            o = cmp(a.arity, b.arity) or cmp(a.functor.__name__, b.functor.__name__)
             if o: return o
-            for a,b in izip(self.args, other.args):
-                a = s[a]
-                b = s[b]
-                if isinstance(a, Term): o = a.cmp(b, s)
-                elif isinstance(b, Term): o = -b.cmp(a, s)
-                else: o = cmp(a, b)
-                if o: return o
-            return 0
+            if _visited(seen, a, b):
+                continue
+            args_a = a.args
+            args_b = b.args
+            for i in xrange(len(args_a)-1, -1, -1):
+                todo.append((args_a[i], args_b[i]))
+        elif o == _ITEMS:
+            if _visited_items(seen, a, b):
+                continue
+            _push_items(todo, a, b)
+        elif o == _VALUE:
+            o = cmp(a, b)
+            if o: return o
+        elif o == _IDS:
+            return cmp(id(a), id(b))
+        else:
+            return o
+    return 0
+
+def sort_key(t, s):
+    """ Python sort key of t consistent with the standard order of terms
+
+    The key is a flat tuple: the term read in pre-order, each node
+    giving its rank followed by its value (variable address, number,
+    string, or arity and functor name). Comparing two keys compares
+    the terms, variables being bound in the stack s. The term must
+    be acyclic.
+    """
+    if not s.acyclic((t,)):
+        raise ValueError("%s is cyclic"%t)
+    key = []
+    push = key.append
+    tag = _tag.get
+    todo = [t]
+    while todo:
+        t = todo.pop()
+        if t is _cons_key:
+            key.extend(_cons_key)
+            continue
+        t = s[t]
+        k = tag(type(t), _OTHER)
+        if k == _COMPOUND:
+            push(4)
+            push(t.arity)
+            push(t.functor.__name__)
+            args = t.args
+            for i in xrange(len(args)-1, -1, -1):
+                todo.append(args[i])
+        elif k == _PACKED:
+            # the items are read as the cons cells they stand for
+            items = t.packed.items
+            todo.append(t.packed.tail)
+            for i in xrange(len(items)-1, t.start, -1):
+                todo.append(items[i])
+                todo.append(_cons_key)
+            todo.append(items[t.start])
+            key.extend(_cons_key)
+        elif k == _VAR:
+            push(0)
+            push(id(t))
         else:
-            return +1
+            push(_rank[k])
+            push(t)
+    return tuple(key)
+
+# key of a cons cell (see sort_key)
+_cons_key = (4, 2, 'cons')
 
 class Term0(Term):
-    def __init__(self): Term.__init__(self)
+    arity = 0
+    def __init__(self):
+        self.args = ()
+        self._hash = _structural_hash(self.__class__, ())
 
 class Term1(Term):
-    def __init__(self, a): Term.__init__(self, a)
+    arity = 1
+    def __init__(self, a):
+        self.args = (a,)
+        self._hash = _structural_hash(self.__class__, self.args)
 
 class Term2(Term):
-    def __init__(self, a, b): Term.__init__(self, a, b)
+    arity = 2
+    def __init__(self, a, b):
+        self.args = (a, b)
+        self._hash = _structural_hash(self.__class__, self.args)
 
 class Term3(Term):
-    def __init__(self, a, b, c): Term.__init__(self, a, b, c)
+    arity = 3
+    def __init__(self, a, b, c):
+        self.args = (a, b, c)
+        self._hash = _structural_hash(self.__class__, self.args)
+
+def _structural_hash(functor, args):
+    hs = [hash(functor)]
+    for arg in args:
+        if isinstance(arg, Term):
+            h = arg._hash
+            if h is None:
+                return None
+        else:
+            try:
+                h = hash(arg)
+            except TypeError:
+                h = 0
+        hs.append(h)
+    return hash(tuple(hs))
+
+def _ground_eq(a, b, typed=False):
+    # structural equality of the ground terms a and b. If typed is
+    # True, atoms are equal only if they have the same type (1 and 1.0
+    # differ, as in hashcons)
+    todo = [(a, b)]
+    while todo:
+        a, b = todo.pop()
+        if a is b:
+            continue
+        if isinstance(a, Term):
+            if not isinstance(b, Term) or a._hash != b._hash:
+                return False
+            if a.functor is not b.functor or a.arity != b.arity:
+                return False
+            if type(a) is plist and type(b) is plist:
+                # atomic items are compared at once
+                items_a = a.packed.items
+                items_b = b.packed.items
+                i = a.start
+                j = b.start
+                n = min(len(items_a)-i, len(items_b)-j)
+                todo.append((a._sublist(i+n), b._sublist(j+n)))
+                if items_a is items_b and i == j:
+                    continue
+                for x, y in izip(items_a[i:i+n], items_b[j:j+n]):
+                    if x is y:
+                        continue
+                    if isinstance(x, Term) or isinstance(y, Term):
+                        todo.append((x, y))
+                    elif x != y or (typed and type(x) is not type(y)):
+                        return False
+            else:
+                todo.extend(izip(_args(a), _args(b)))
+        elif isinstance(b, Term) or a != b or (typed and type(a) is not type(b)):
+            return False
+    return True
+
+class GroundKey(object):
+    """ Dictionary key for ground terms
+
+    Terms are hashed by identity and == builds an Eq goal. A GroundKey
+    wraps a ground term and uses its cached structural hash and
+    structural equality instead, so that identical ground terms give
+    the same key in indexes and memo tables. Atoms are compared by
+    type and value, as hashcons keys them: f(1) and f(1.0) give
+    different keys.
+    """
+
+    __slots__ = ('term', 'hash')
+
+    def __init__(self, term):
+        if isinstance(term, Term):
+            if term._hash is None:
+                raise TypeError("%s is not ground"%term)
+            self.hash = term._hash
+        else:
+            self.hash = hash(term)
+        self.term = term
+
+    def __hash__(self):
+        return self.hash
+
+    def __eq__(self, other):
+        if not isinstance(other, GroundKey) or self.hash != other.hash:
+            return False
+        return _ground_eq(self.term, other.term, True)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
 
 class Var(Term):
     """ Variables
     """
 
+    __slots__ = ('name', 'store', 'slot')
+
     _n = 0
+    _hash = None
 
     def __init__(self, name=None):
-        Term.__init__(self, name)
+        self.args = (name,)
         Var._n += 1
         self.name = name or "_%s"%Var._n
+        self.store = None
+        self.slot = None
 
     def __str__(self, L=None):
         return self.name
@@ -124,64 +518,655 @@ class Var(Term):
     def __hash__(self):
         return id(self)
 
-    def copy(self, s, memo):
-        try:
-            obj = memo[id(self)]
-        except KeyError:
-            obj = s[self]
-            if isinstance(obj, Var):
-                memo[id(self)] = obj
-            elif isinstance(obj, Term):
-                obj = copy.copy(obj)
-                memo[id(self)] = obj
-                memo[id(obj)] = obj
-                obj.rebuild(s, memo)
-        return obj
-
-    def cmp(self, other, s):
-        a = s[self]
-        b = s[other]
-        if a is not self:
-            return a.cmp(b, s)
-        if isinstance(other, Var):
-            return cmp(id(self), id(other))
-        else:
-            return -1
+_tag[Var] = _VAR
 
 class cons(Term2): pass
 class nil(Term0): pass
 nil = nil()
 
+class pair(Term2):
+    """ Key-Value pair (Key-Value in Prolog) """
+
+def _list_items(l, s):
+    # items of the proper list l or None if l is not a proper list
+    items = []
+    l = s[l]
+    while isinstance(l, cons):
+        if isinstance(l, plist):
+            items.extend(l.packed.items[l.start:])
+            l = s[l.packed.tail]
+            continue
+        items.append(l.args[0])
+        l = s[l.args[1]]
+    if l is not nil:
+        return None
+    return items
+
+def _make_list(items, tail=nil):
+    if not items:
+        return tail
+    return plist(items, tail)
+
+class _Packed(object):
+    """ Items and tail shared by a packed list and its sublists """
+
+    __slots__ = ('items', 'tail', 'hashes')
+
+    def __init__(self, items, tail):
+        self.items = items
+        self.tail = tail
+        self.hashes = None
+
+    def hash(self, start):
+        # structural hashes of the sublists, computed once for all
+        # the sublists as cons(items[i], ...) would compute them
+        hashes = self.hashes
+        if hashes is None:
+            items = self.items
+            hashes = [None] * len(items)
+            h = self.tail
+            if isinstance(h, Term):
+                h = h._hash
+            else:
+                try:
+                    h = hash(h)
+                except TypeError:
+                    h = 0
+            if h is not None:
+                hc = hash(cons)
+                for i in xrange(len(items)-1, -1, -1):
+                    item = items[i]
+                    if isinstance(item, Term):
+                        hi = item._hash
+                        if hi is None:
+                            break
+                    else:
+                        try:
+                            hi = hash(item)
+                        except TypeError:
+                            hi = 0
+                    h = hashes[i] = hash((hc, hi, h))
+            self.hashes = hashes
+        return hashes[start]
+
+class plist(cons):
+    """ Packed list
+
+    plist(items, tail) is the list cons(items[0], cons(items[1], ...
+    tail)) stored as a tuple of items. It unifies, compares and prints
+    as the equivalent cons cells, but is built in bulk from a Python
+    sequence. The tail of a packed list (args[1]) is a sublist sharing
+    the same tuple (no copy), created when it is first needed.
+    """
+
+    __slots__ = ('packed', 'start', 'rest', '_h')
+
+    def __init__(self, items, tail=nil):
+        items = tuple(items)
+        if not items:
+            raise ValueError("empty packed list")
+        self._fill(items, tail)
+
+    def _fill(self, items, tail):
+        self.packed = _Packed(tuple(items), tail)
+        self.start = 0
+        self.rest = _nothing
+        self._h = _nothing
+
+    def __copy__(self):
+        return object.__new__(plist)
+
+    def _sublist(self, start):
+        # sublist of the packed list starting at items[start]
+        packed = self.packed
+        if start >= len(packed.items):
+            return packed.tail
+        if start == self.start:
+            return self
+        l = object.__new__(plist)
+        l.packed = packed
+        l.start = start
+        l.rest = _nothing
+        l._h = _nothing
+        return l
+
+    def args(self):
+        rest = self.rest
+        if rest is _nothing:
+            rest = self.rest = self._sublist(self.start+1)
+        return (self.packed.items[self.start], rest)
+    args = property(args)
+
+    def _get_hash(self):
+        h = self._h
+        if h is _nothing:
+            h = self._h = self.packed.hash(self.start)
+        return h
+
+    def _set_hash(self, h):
+        self._h = h
+
+    _hash = property(_get_hash, _set_hash)
+
+plist.functor = cons
+_tag[plist] = _PACKED
+
+def _children(t):
+    # arguments of the compound term t, or items and tail of the packed
+    # list t: walking a packed list through args would create (and
+    # cache) one sublist per item
+    if type(t) is plist:
+        return t.packed.items[t.start:] + (t.packed.tail,)
+    return t.args
+
+def _args(t):
+    # arguments of the compound term t, without caching the sublist of
+    # a packed list
+    if type(t) is plist:
+        return (t.packed.items[t.start], t._sublist(t.start+1))
+    return t.args
+
+# Conversion between Python objects and terms
+
+def to_term(obj):
+    """ Term built from the Python object obj
+
+    Python lists and tuples become (packed) lists, dictionaries become
+    lists of pair(Key, Value) sorted by keys in the standard order of
+    terms. Other objects are left unchanged. Nested containers are
+    converted iteratively.
+    """
+    root = [obj]
+    todo = [(root, 0)]
+    fixups = []
+    while todo:
+        container, index = todo.pop()
+        obj = container[index]
+        if isinstance(obj, (list, tuple)):
+            items = list(obj)
+            container[index] = items
+            fixups.append((container, index, False))
+            for i in xrange(len(items)-1, -1, -1):
+                if isinstance(items[i], _containers):
+                    todo.append((items, i))
+        elif isinstance(obj, dict):
+            items = [[k, v] for k, v in obj.iteritems()]
+            container[index] = items
+            fixups.append((container, index, True))
+            for i in xrange(len(items)-1, -1, -1):
+                kv = items[i]
+                if isinstance(kv[1], _containers):
+                    todo.append((kv, 1))
+                if isinstance(kv[0], _containers):
+                    todo.append((kv, 0))
+    # containers are built bottom-up (the inner ones were found last)
+    for i in xrange(len(fixups)-1, -1, -1):
+        container, index, is_dict = fixups[i]
+        items = container[index]
+        if is_dict:
+            s = Stack()
+            items = [pair(k, v) for k, v in items]
+            items.sort(key=lambda kv: sort_key(kv.args[0], s))
+        container[index] = _make_list(items)
+    return root[0]
+
+_containers = (list, tuple, dict)
+
+def from_term(t, s=None):
+    """ Python object built from the term t
+
+    Proper lists become Python lists and pair(Key, Value) terms become
+    (Key, Value) tuples. The lists of a Key become tuples, so that it
+    is hashable: dict(from_term(to_term(d))) == d for a dictionary d
+    whose values contain no tuple or dictionary (they come back as
+    lists). Other terms and partial lists are left as terms. If a stack s is given, variables are dereferenced in s while
+    converting, without copying t first (terms left as terms are
+    copied as s(t) does).
+    """
+    if s is None:
+        s = Stack()
+    if not s.acyclic((t,)):
+        raise ValueError("%s is cyclic"%t)
+    root = [t]
+    todo = [(root, 0)]
+    fixups = []
+    while todo:
+        container, index = todo.pop()
+        t = s[container[index]]
+        if isinstance(t, cons):
+            items = []
+            l = t
+            while isinstance(l, cons):
+                if isinstance(l, plist):
+                    items.extend(l.packed.items[l.start:])
+                    l = s[l.packed.tail]
+                else:
+                    items.append(l.args[0])
+                    l = s[l.args[1]]
+            if l is not nil:
+                container[index] = s(t)
+                continue
+        elif t is nil:
+            container[index] = []
+            continue
+        elif isinstance(t, pair):
+            items = list(t.args)
+            fixups.append((container, index))
+        elif isinstance(t, Term) and not isinstance(t, Var):
+            container[index] = s(t)
+            continue
+        else:
+            container[index] = t
+            continue
+        container[index] = items
+        for i in xrange(len(items)-1, -1, -1):
+            x = items[i]
+            if isinstance(x, Term):
+                todo.append((items, i))
+    # pairs are built bottom-up (the inner ones were found last)
+    for i in xrange(len(fixups)-1, -1, -1):
+        container, index = fixups[i]
+        items = container[index]
+        if isinstance(items[0], _sequences):
+            items[0] = _hashable(items[0])
+        container[index] = tuple(items)
+    return root[0]
+
+_sequences = (list, tuple)
+
+def _hashable(obj):
+    # obj where nested lists are replaced by tuples
+    root = [obj]
+    todo = [(root, 0)]
+    fixups = []
+    while todo:
+        container, index = todo.pop()
+        items = container[index] = list(container[index])
+        fixups.append((container, index))
+        for i in xrange(len(items)):
+            if isinstance(items[i], _sequences):
+                todo.append((items, i))
+    for i in xrange(len(fixups)-1, -1, -1):
+        container, index = fixups[i]
+        container[index] = tuple(container[index])
+    return root[0]
+
+# Writing terms
+
+_bare_atom = re.compile(r"^[a-z][a-zA-Z0-9_]*$")
+
+def _quote(atom):
+    if _bare_atom.match(atom):
+        return atom
+    atom = atom.replace('\\', '\\\\').replace("'", "\\'").replace('\n', '\\n')
+    return "'%s'"%atom
+
+def _atom_text(a, quoted):
+    if type(a) is int or type(a) is long:
+        return str(a)
+    if type(a) is float:
+        return repr(a)
+    if not isinstance(a, basestring):
+        a = str(a)
+    if quoted:
+        return _quote(a)
+    return a
+
+def _negative(a):
+    return (type(a) is int or type(a) is long or type(a) is float) and a < 0
+
+def write_term(t, out, s=None, quoted=True, max_depth=None, max_length=None):
+    """ Writes the term t to the file-like object out
+
+    Variables are dereferenced in the stack s (no copy of t is made).
+    Distinct variables with the same name get distinct names (X, X_1,
+    ...). Lists are written as [a,b|T] and pair(K, V) as K-V, with
+    parentheses around a right operand that is a pair and around
+    negative numbers (1-(2-3), (-1)-(-2)). If quoted is True, atoms
+    and functors that need it are written between quotes.
+    Terms deeper than max_depth, list elements beyond max_length and
+    cyclic subterms are written as '...'. The term is written through
+    a buffer, so it is never built as a whole string.
+    """
+    if s is None:
+        s = Stack()
+    buf = []
+    write = buf.append
+    path = set()
+    names = {}
+    var_names = {}
+    used = set()
+    # todo: (separator, term, depth), (text, None, None) or
+    # (None, id of a term on the path, None)
+    todo = [('', t, 0)]
+    while todo:
+        if len(buf) >= 4096:
+            out.write(''.join(buf))
+            del buf[:]
+        sep, t, depth = todo.pop()
+        if depth is None:
+            if sep is None:
+                path.discard(t)
+            else:
+                write(sep)
+            continue
+        write(sep)
+        t = s[t]
+        if not isinstance(t, Term):
+            write(_atom_text(t, quoted))
+        elif isinstance(t, Var):
+            name = var_names.get(id(t))
+            if name is None:
+                name = t.name
+                i = 0
+                while name in used:
+                    i += 1
+                    name = "%s_%d"%(t.name, i)
+                used.add(name)
+                var_names[id(t)] = name
+            write(name)
+        elif t is nil:
+            write('[]')
+        elif (max_depth is not None and depth >= max_depth) or id(t) in path:
+            write('...')
+        elif isinstance(t, cons):
+            items = []
+            cells = []
+            l = t
+            while isinstance(l, cons):
+                if max_length is not None and len(items) >= max_length:
+                    break
+                if l._hash is None:
+                    if id(l) in path:
+                        break
+                    path.add(id(l))
+                    cells.append(id(l))
+                if isinstance(l, plist):
+                    start = l.start
+                    end = len(l.packed.items)
+                    if max_length is not None:
+                        end = min(end, start + max_length - len(items))
+                    items.extend(l.packed.items[start:end])
+                    l = s[l._sublist(end)]
+                else:
+                    items.append(l.args[0])
+                    l = s[l.args[1]]
+            if not items:
+                # max_length is 0
+                write('[...]')
+                continue
+            for c in cells:
+                todo.append((None, c, None))
+            todo.append((']', None, None))
+            if isinstance(l, cons):
+                todo.append(('|...', None, None))
+            elif l is not nil:
+                todo.append(('|', l, depth+1))
+            depth = depth + 1
+            for i in xrange(len(items)-1, 0, -1):
+                todo.append((',', items[i], depth))
+            todo.append(('[', items[0], depth))
+        else:
+            args = t.args
+            if isinstance(t, pair):
+                if t._hash is None:
+                    path.add(id(t))
+                    todo.append((None, id(t), None))
+                # - is left associative (yfx): 1-2-3 is pair(pair(1, 2), 3)
+                left = s[args[0]]
+                right = s[args[1]]
+                if isinstance(right, pair) or _negative(right):
+                    todo.append((')', None, None))
+                    todo.append(('-(', right, depth+1))
+                else:
+                    todo.append(('-', right, depth+1))
+                if _negative(left):
+                    todo.append((')', None, None))
+                    todo.append(('(', left, depth+1))
+                else:
+                    todo.append(('', left, depth+1))
+                continue
+            name = names.get(t.functor)
+            if name is None:
+                name = t.functor.__name__
+                if quoted:
+                    name = _quote(name)
+                names[t.functor] = name
+            if not args:
+                write(name)
+                continue
+            for a in args:
+                if isinstance(a, Term):
+                    break
+            else:
+                # atomic arguments are written at once
+                write("%s(%s)"%(name, ','.join([_atom_text(a, quoted) for a in args])))
+                continue
+            if t._hash is None:
+                path.add(id(t))
+                todo.append((None, id(t), None))
+            todo.append((')', None, None))
+            depth = depth + 1
+            for i in xrange(len(args)-1, 0, -1):
+                todo.append((',', args[i], depth))
+            todo.append((name+'(', args[0], depth))
+    out.write(''.join(buf))
+
+# Hash consing
+#
+# Ground terms built by hashcons are canonical: two identical ground
+# terms built by hashcons are the same object, so they are stored once
+# and compared by identity. Atoms are keyed by their type and value,
+# so that f(1), f(1.0) and f(True) stay distinct terms. The table is
+# weak: canonical terms vanish with their last reference.
+
+_hashcons = weakref.WeakValueDictionary()
+_canonical = weakref.WeakValueDictionary()
+
+def is_canonical(t):
+    """ True if t is a canonical ground term built by hashcons """
+    return _canonical.get(id(t)) is t
+
+def _hashcons_key(functor, args):
+    key = [functor]
+    for arg in args:
+        if isinstance(arg, Term):
+            if _canonical.get(id(arg)) is not arg:
+                return None
+            key.append(id(arg))
+        else:
+            key.append(type(arg))
+            key.append(arg)
+    key = tuple(key)
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+def _hashcons_register(key, t):
+    _hashcons[key] = t
+    _canonical[id(t)] = t
+    return t
+
+def hashcons(functor, *args):
+    """ Build functor(*args) as a canonical term
+
+    If all the arguments are atoms or canonical terms, the canonical
+    instance of functor(*args) is returned (and created if needed).
+    Otherwise the term is not ground and a new term is built.
+    """
+    key = _hashcons_key(functor, args)
+    if key is None:
+        return functor(*args)
+    try:
+        return _hashcons[key]
+    except KeyError:
+        return _hashcons_register(key, functor(*args))
+
+def canonical(t):
+    """ Share the ground subterms of t with their canonical instances
+
+    Returns t where every ground subterm has been replaced by its
+    canonical instance (see hashcons). Terms loaded in bulk through
+    canonical share their identical ground substructures.
+    """
+    memo = {}
+    todo = [(t, False)]
+    seen = set()
+    while todo:
+        u, done = todo.pop()
+        if not done:
+            if isinstance(u, Term) and not isinstance(u, Var) and not isinstance(u, plist) and id(u) not in seen:
+                seen.add(id(u))
+                if _canonical.get(id(u)) is u:
+                    memo[id(u)] = u
+                    continue
+                todo.append((u, True))
+                for arg in u.args:
+                    todo.append((arg, False))
+            continue
+        args = tuple([memo.get(id(arg), arg) for arg in u.args])
+        key = _hashcons_key(u.functor, args)
+        if key is not None:
+            try:
+                memo[id(u)] = _hashcons[key]
+                continue
+            except KeyError:
+                pass
+        for a, b in izip(args, u.args):
+            if a is not b:
+                v = copy.copy(u)
+                v.args = args
+                v._hash = _structural_hash(v.functor, args)
+                break
+        else:
+            v = u
+        if key is not None:
+            _hashcons_register(key, v)
+        memo[id(u)] = v
+    return memo.get(id(t), t)
+
 ###########################################################
 #
 # Stack of variable bindings
 #
 ###########################################################
 
-class Stack:
+# Actions of Stack._unify
+_FAIL, _BIND1, _BIND2, _ALIAS = 4, 5, 6, 7
+
+_unify_table = [
+    #  Var      Compound   str      int      float    other    packed
+    [_ALIAS,  _BIND1,    _BIND1,  _BIND1,  _BIND1,  _BIND1,  _BIND1],    # Var
+    [_BIND2,  _ARGS,     _FAIL,   _FAIL,   _FAIL,   _FAIL,   _ARGS],     # Compound
+    [_BIND2,  _FAIL,     _VALUE,  _FAIL,   _FAIL,   _VALUE,  _FAIL],     # str
+    [_BIND2,  _FAIL,     _FAIL,   _VALUE,  _VALUE,  _VALUE,  _FAIL],     # int
+    [_BIND2,  _FAIL,     _FAIL,   _VALUE,  _VALUE,  _VALUE,  _FAIL],     # float
+    [_BIND2,  _FAIL,     _VALUE,  _VALUE,  _VALUE,  _VALUE,  _FAIL],     # other
+    [_BIND2,  _ARGS,     _FAIL,   _FAIL,   _FAIL,   _FAIL,   _ITEMS],    # packed
+]
+
+class Stack(object):
     """ Variable bindings stack
 
     Unification creates a new stack with one more item
     containing new bindings.
+
+    To keep the chain of frames short, squash_limit consecutive frames
+    of the same weight (number of unifications they contain) are
+    automatically squashed into a single frame when a new frame is
+    pushed. Set squash_limit to 0 to disable this policy.
+
+    Unification works on rational trees: pairs of compound terms already
+    met during a unification are not unified again, so cyclic terms
+    (e.g. built by unify(f(A), A)) unify in time linear in their size.
+    Set rational to False to unify finite trees only.
     """
 
+    __slots__ = ('parent', 'vars', 'weight', 'depth', 'run')
+
+    squash_limit = 32
+
+    rational = True
+
     def __init__(self, parent=None):
         self.parent = parent
         self.vars = {}
+        self.weight = 1
+        if parent is None:
+            self.depth = 1
+            self.run = 1
+        else:
+            self.depth = parent.depth + 1
+            if parent.weight == 1:
+                self.run = parent.run + 1
+            else:
+                self.run = 1
 
     def new(self):
-        return Stack(parent=self)
+        s = self
+        if self.squash_limit:
+            while s.run >= self.squash_limit:
+                base = s
+                for i in xrange(s.run):
+                    base = base.parent
+                s = s.squash(base)
+        return Stack(parent=s)
+
+    def squash(self, base=None):
+        """ Squash the frames above base into a single frame
+
+        base is an older stack of the same search (usually an ancestor
+        of self). The new frame contains the same bindings as self.
+        self and the intermediate frames are left unchanged so that
+        choice points still referencing them remain valid.
+        """
+        if base is None:
+            depth = 0
+        else:
+            depth = base.depth
+        frames = []
+        s = self
+        while s is not None and s.depth > depth:
+            frames.append(s)
+            s = s.parent
+        if len(frames) < 2:
+            return self
+        squashed = Stack(parent=s)
+        squashed.weight = self.depth - squashed.depth + 1
+        squashed.depth = self.depth
+        if s is not None and s.weight == squashed.weight:
+            squashed.run = s.run + 1
+        else:
+            squashed.run = 1
+        vars = squashed.vars
+        for s in reversed(frames):
+            vars.update(s.vars)
+        return squashed
+
+    def allocated(self):
+        """ Size of the storage shared by the stacks of the search (see reclaim) """
+        return None
+
+    def reclaim(self, allocated):
+        """ Stack with the bindings of self, releasing the shared storage
+        allocated since allocated() was called on an older stack
+
+        The younger stacks are no longer valid. Frames are not shared,
+        so this is self.
+        """
+        return self
 
     def __getitem__(self, item):
         while isinstance(item, Var):
-            try:
-                item2 = self.vars[item]
-            except KeyError, e:
-                try:
-                    item2 = self.parent[item]
-                except TypeError:
-                    return item
-            if item2 is item:
+            s = self
+            while s is not None:
+                item2 = s.vars.get(item, s)
+                if item2 is not s:
+                    break
+                s = s.parent
+            else:
                 break
             item = item2
         return item
@@ -207,147 +1192,514 @@ class Stack:
             yield u
 
     def _unify(self, T1, T2, occurs_check=False):
-        T1 = self[T1]
-        T2 = self[T2]
-        if T1 is T2: return True
-        if isinstance(T1, Var):
-            if isinstance(T2, Var):
-                self[T1] = T2
-            elif isinstance(T2, Term):
-                if occurs_check and self.contains(T2, T1): return False
-                self[T1] = T2
-            else:
-                self[T1] = T2
-        elif isinstance(T1, Term):
-            if isinstance(T2, Var):
-                if occurs_check and self.contains(T1, T2): return False
-                self[T2] = T1
-            elif isinstance(T2, Term):
+        # The occurs check is postponed: terms are unified as rational
+        # trees and the unification fails if one of the new bindings
+        # makes a cycle (acyclic walks each subterm only once).
+        todo = [(T1, T2)]
+        seen = set()
+        rational = self.rational or occurs_check
+        bound = []
+        tag = _tag.get
+        table = _unify_table
+        while todo:
+            T1, T2 = todo.pop()
+            T1 = self[T1]
+            T2 = self[T2]
+            if T1 is T2: continue
+            action = table[tag(type(T1), _OTHER)][tag(type(T2), _OTHER)]
+            if action == _ARGS:
                 if T1.functor != T2.functor: return False
                 if T1.arity != T2.arity: return False
-                for x, y in izip(T1.args, T2.args):
-                    if not self._unify(x, y): return False
-            else:
-                return False
-        else:
-            if isinstance(T2, Var):
+                if rational and (T1._hash is None or T2._hash is None):
+                    key = (id(T1), id(T2))
+                    if key in seen: continue
+                    seen.add(key)
+                args1 = T1.args
+                args2 = T2.args
+                for i in xrange(len(args1)-1, -1, -1):
+                    todo.append((args1[i], args2[i]))
+            elif action == _ITEMS:
+                if rational and _visited_items(seen, T1, T2): continue
+                _push_items(todo, T1, T2)
+            elif action == _VALUE:
+                if T1 != T2: return False
+            elif action == _BIND1:
+                if occurs_check: bound.append(T1)
+                self[T1] = T2
+            elif action == _BIND2:
+                if occurs_check: bound.append(T2)
                 self[T2] = T1
-            elif isinstance(T2, Term):
-                return False
+            elif action == _ALIAS:
+                self._alias(T1, T2)
+                if occurs_check: bound.append(T1)
             else:
-                if T1 != T2:
-                    return False
+                return False
+        if bound:
+            return self.acyclic(bound)
         return True
 
+    def _alias(self, v1, v2):
+        self[v1] = v2
+
     def contains(self, t, v):
+        """ True if v occurs in t
+
+        Each compound subterm is visited once, so this terminates on
+        cyclic terms. Ground subterms cannot contain a variable v, they
+        are skipped.
+        """
+        v = self[v]
+        var = isinstance(v, Var)
         seen = set()
-        ts = set([t])
-        while ts:
-            t = self[ts.pop()]
-            if t not in seen:
-                seen.add(t)
-                if t is v: return True
-                if isinstance(t, Term) and not isinstance(t, Var):
-                    for arg in t.args:
-                        ts.add(arg)
+        todo = [t]
+        while todo:
+            t = self[todo.pop()]
+            if t is v:
+                return True
+            if isinstance(t, Term) and not isinstance(t, Var) and not (var and t._hash is not None) and id(t) not in seen:
+                seen.add(id(t))
+                todo.extend(_children(t))
         return False
 
-###########################################################
-#
-# Pylog predicates
-#
-###########################################################
+    def acyclic(self, ts):
+        """ True if no cycle can be reached from the terms ts
 
-class Rec(Term):
-    """ Recursive call of a predicate
-    """
+        Depth-first search of the non ground compound subterms, each
+        one being visited once whatever the number of roots.
+        """
+        done = set()
+        path = set()
+        for t in ts:
+            t = self[t]
+            if isinstance(t, Var) or not isinstance(t, Term) or t._hash is not None or id(t) in done:
+                continue
+            path.add(id(t))
+            todo = [(t, iter(_children(t)))]
+            while todo:
+                node, args = todo[-1]
+                for arg in args:
+                    if not isinstance(arg, Term):
+                        continue
+                    arg = self[arg]
+                    if isinstance(arg, Var) or not isinstance(arg, Term) or arg._hash is not None:
+                        continue
+                    key = id(arg)
+                    if key in path: return False
+                    if key not in done:
+                        path.add(key)
+                        todo.append((arg, iter(_children(arg))))
+                        break
+                else:
+                    todo.pop()
+                    path.remove(id(node))
+                    done.add(id(node))
+        return True
 
-    def __call__(self, s):
-        return self.args[0](*self.args[1:])(s)
+# Empty stack used to copy terms without bindings
+_no_bindings = Stack()
 
-class Not(Term1):
-    """ Negation
-    """
+_unbound = object()
 
-    def __call__(self, s):
-        for s in self.args[0](s):
-            return
-        yield s
+class _Trail:
+    """ Destructive bindings shared by all the stacks of a query
 
-###########################################################
-#
-# Pylog library
-#
-###########################################################
+    Variables are numbered with dense integer slots the first time
+    they are bound in the store and their values are stored in a list
+    indexed by slot. A variable remembers its slot (Var.slot) in the
+    last store that numbered it, other stores fall back to a dict. The
+    variable refers to this store through a weak reference (Var.store),
+    so that variables outliving a query do not keep its store alive.
 
-# Verify Type of a Term
+    Variable-variable bindings form a union-find forest: the variable
+    of lower rank is bound to the other one and chains of variables
+    are compressed when dereferenced.
 
-class IsVar(Term):
-    """ IsVar(+Term)
-    Succeeds if Term currently is a free variable.
+    Every change is recorded on the trail so that it can be undone
+    when backtracking. A trail entry is:
+        slot            the variable was bound
+        ~slot           the rank of the variable was incremented
+        (slot, value)   the variable was bound to value (compression)
     """
 
-    def __call__(self, s):
-        for v in self.args:
-            if not isinstance(s[v], Var):
-                break
-        else:
-            yield s
+    def __init__(self):
+        self.vars = []
+        self.values = []
+        self.ranks = []
+        self.foreign = {}
+        self.trail = []
+        self.ref = weakref.ref(self)
 
-class IsNonVar(Term):
-    """ IsNonVar(+Term)
-    Succeeds if Term currently is not a free variable.
-    """
+    def slot(self, var):
+        if var.store is self.ref:
+            return var.slot
+        try:
+            return self.foreign[var]
+        except KeyError:
+            if var.store is not None:
+                store = var.store()
+                if store is not None:
+                    store.foreign[var] = var.slot
+            var.store = self.ref
+            var.slot = len(self.values)
+            self.vars.append(var)
+            self.values.append(_unbound)
+            self.ranks.append(0)
+            return var.slot
 
-    def __call__(self, s):
-        for v in self.args:
-            if isinstance(s[v], Var):
-                break
-        else:
-            yield s
+    def undo(self, mark):
+        values = self.values
+        trail = self.trail
+        while len(trail) > mark:
+            entry = trail.pop()
+            if type(entry) is tuple:
+                values[entry[0]] = entry[1]
+            elif entry >= 0:
+                values[entry] = _unbound
+            else:
+                self.ranks[~entry] -= 1
 
-class IsInteger(Term):
-    """ IsInteger(+Term)
-    Succeeds if Term is bound to an integer.
-    """
+    def release(self, size):
+        # forgets the slots numbered since the store had size slots
+        for var in self.vars[size:]:
+            if var.store is self.ref:
+                var.store = None
+        del self.vars[size:]
+        del self.values[size:]
+        del self.ranks[size:]
+        if self.foreign:
+            for var, slot in self.foreign.items():
+                if slot >= size:
+                    del self.foreign[var]
 
-    def __call__(self, s):
-        for v in self.args:
-            if not isinstance(s[v], (int, long)):
-                break
-        else:
-            yield s
+class TrailStack(Stack):
+    """ Trail-based variable bindings stack
 
-class IsFloat(Term):
-    """ IsFloat(+Term)
-    Succeeds if Term is bound to a floating point number.
+    Variables are bound destructively in a single store and recorded
+    on a trail. A stack is only a mark on this trail: using a stack
+    undoes the bindings made after it. Dereferencing a variable never
+    walks parent frames, it is a list index. Aliased variables are
+    managed with union-find (union by rank and path compression).
+
+    Stacks shall be used in the chronological order of a depth-first
+    search: once an older stack has been used, the younger ones are
+    no longer valid (their bindings have been undone).
+    This is what And, Or, Not, ... do, so a query can be run with:
+
+        for s in query(TrailStack()): ...
     """
 
-    def __call__(self, s):
-        for v in self.args:
-            if not isinstance(s[v], float):
-                break
-        else:
-            yield s
+    __slots__ = ('store', 'start', 'mark')
 
+    def __init__(self, store=None, mark=0):
+        if store is None:
+            store = _Trail()
+        self.store = store
+        self.start = mark
+        self.mark = mark
 
-class IsNumber(Term):
-    """ IsNumber(+Term)
-    Succeeds if Term is bound to an integer or floating point number.
-    """
+    def new(self):
+        self.restore()
+        return TrailStack(self.store, self.mark)
 
-    def __call__(self, s):
-        for n in self.args:
-            if not isinstance(s[n], (int, long, float)):
-                break
-        else:
-            yield s
+    def restore(self):
+        if len(self.store.trail) > self.mark:
+            self.store.undo(self.mark)
 
-class IsAtom(Term):
+    def vars(self):
+        self.restore()
+        store = self.store
+        vars = {}
+        for slot in store.trail[self.start:self.mark]:
+            if type(slot) is int and slot >= 0:
+                vars[store.vars[slot]] = store.values[slot]
+        return vars
+    vars = property(vars)
+
+    def __getitem__(self, item):
+        store = self.store
+        trail = store.trail
+        if len(trail) > self.mark:
+            store.undo(self.mark)
+        values = store.values
+        ref = store.ref
+        first = item
+        hops = 0
+        while isinstance(item, Var):
+            if item.store is ref:
+                value = values[item.slot]
+            else:
+                try:
+                    value = values[store.foreign[item]]
+                except KeyError:
+                    break
+            if value is _unbound:
+                break
+            item = value
+            hops += 1
+        if hops > 1:
+            # path compression: the variables of the chain are bound to its end
+            var = first
+            while hops > 1:
+                slot = store.slot(var)
+                var = values[slot]
+                trail.append((slot, var))
+                values[slot] = item
+                hops -= 1
+            self.mark = len(trail)
+        return item
+
+    def __setitem__(self, item, value):
+        assert isinstance(item, Var)
+        store = self.store
+        slot = store.slot(item)
+        store.values[slot] = value
+        store.trail.append(slot)
+        self.mark = len(store.trail)
+
+    def _alias(self, v1, v2):
+        store = self.store
+        s1 = store.slot(v1)
+        s2 = store.slot(v2)
+        ranks = store.ranks
+        if ranks[s1] > ranks[s2]:
+            v1, v2, s1, s2 = v2, v1, s2, s1
+        store.values[s1] = v2
+        store.trail.append(s1)
+        if ranks[s1] == ranks[s2]:
+            ranks[s2] += 1
+            store.trail.append(~s2)
+        self.mark = len(store.trail)
+
+    def unify(self, T1, T2):
+        u = self.new()
+        if u._unify(T1, T2):
+            yield u
+        else:
+            self.restore()
+
+    def unify_with_occurs_check(self, T1, T2):
+        u = self.new()
+        if u._unify(T1, T2, occurs_check=True):
+            yield u
+        else:
+            self.restore()
+
+    def squash(self, base=None):
+        return self
+
+    def allocated(self):
+        return len(self.store.values)
+
+    def reclaim(self, allocated):
+        # the slots numbered after allocated are bound after self
+        self.restore()
+        self.store.release(allocated)
+        return self
+
+# Persistent hash array mapped trie
+#
+# A node is a 16 bit bitmap and a tuple of entries (one per bit set).
+# An entry is either a sub-node or a (key, value) leaf. Updates copy
+# the path from the root to the modified leaf, the rest of the trie is
+# shared with the previous version.
+
+_POPCOUNT = [0]*65536
+for _i in xrange(1, 65536):
+    _POPCOUNT[_i] = _POPCOUNT[_i>>1] + (_i&1)
+del _i
+
+def _hamt_hash(key):
+    return id(key) >> 3
+
+class _HamtNode(object):
+    __slots__ = ('bitmap', 'entries')
+
+    def __init__(self, bitmap, entries):
+        self.bitmap = bitmap
+        self.entries = entries
+
+    def get(self, key, default=None):
+        h = _hamt_hash(key)
+        node = self
+        while True:
+            bit = 1 << (h & 15)
+            if not node.bitmap & bit:
+                return default
+            entry = node.entries[_POPCOUNT[node.bitmap & (bit-1)]]
+            if type(entry) is tuple:
+                if entry[0] is key:
+                    return entry[1]
+                return default
+            node = entry
+            h >>= 4
+
+    def assoc(self, key, value):
+        return self._assoc(key, _hamt_hash(key), 0, value)
+
+    def _assoc(self, key, h, shift, value):
+        bit = 1 << ((h >> shift) & 15)
+        i = _POPCOUNT[self.bitmap & (bit-1)]
+        entries = self.entries
+        if not self.bitmap & bit:
+            return _HamtNode(self.bitmap | bit, entries[:i] + ((key, value),) + entries[i:])
+        entry = entries[i]
+        if type(entry) is not tuple:
+            entry = entry._assoc(key, h, shift+4, value)
+        elif entry[0] is key:
+            entry = (key, value)
+        else:
+            entry = _HamtNode(0, ())._assoc(entry[0], _hamt_hash(entry[0]), shift+4, entry[1])
+            entry = entry._assoc(key, h, shift+4, value)
+        return _HamtNode(self.bitmap, entries[:i] + (entry,) + entries[i+1:])
+
+_hamt_empty = _HamtNode(0, ())
+
+class HamtStack(Stack):
+    """ Persistent variable bindings stack
+
+    Bindings are stored in a persistent hash array mapped trie keyed
+    by variables. Unification creates a new version of the trie in
+    O(log n), sharing most of its structure with the previous one.
+    Old stacks remain valid (as with Stack) but there is no parent
+    frame to walk when dereferencing a variable.
+    """
+
+    __slots__ = ('bindings',)
+
+    def __init__(self, bindings=_hamt_empty):
+        self.bindings = bindings
+        self.vars = {}
+
+    def new(self):
+        return HamtStack(self.bindings)
+
+    def __getitem__(self, item):
+        get = self.bindings.get
+        while isinstance(item, Var):
+            item2 = get(item, item)
+            if item2 is item:
+                break
+            item = item2
+        return item
+
+    def __setitem__(self, item, value):
+        assert isinstance(item, Var)
+        self.vars[item] = value
+        self.bindings = self.bindings.assoc(item, value)
+
+    def squash(self, base=None):
+        return self
+
+###########################################################
+#
+# Pylog predicates
+#
+###########################################################
+
+class Rec(Term):
+    """ Recursive call of a predicate
+    """
+
+    def __call__(self, s):
+        return self.args[0](*self.args[1:])(s)
+
+class Not(Term1):
+    """ Negation
+    """
+
+    deterministic = True
+
+    def __call__(self, s):
+        for s in self.args[0](s):
+            return
+        yield s
+
+###########################################################
+#
+# Pylog library
+#
+###########################################################
+
+# Verify Type of a Term
+
+class IsVar(Term):
+    """ IsVar(+Term)
+    Succeeds if Term currently is a free variable.
+    """
+
+    deterministic = True
+
+    def __call__(self, s):
+        for v in self.args:
+            if not isinstance(s[v], Var):
+                break
+        else:
+            yield s
+
+class IsNonVar(Term):
+    """ IsNonVar(+Term)
+    Succeeds if Term currently is not a free variable.
+    """
+
+    deterministic = True
+
+    def __call__(self, s):
+        for v in self.args:
+            if isinstance(s[v], Var):
+                break
+        else:
+            yield s
+
+class IsInteger(Term):
+    """ IsInteger(+Term)
+    Succeeds if Term is bound to an integer.
+    """
+
+    deterministic = True
+
+    def __call__(self, s):
+        for v in self.args:
+            if not isinstance(s[v], (int, long)):
+                break
+        else:
+            yield s
+
+class IsFloat(Term):
+    """ IsFloat(+Term)
+    Succeeds if Term is bound to a floating point number.
+    """
+
+    deterministic = True
+
+    def __call__(self, s):
+        for v in self.args:
+            if not isinstance(s[v], float):
+                break
+        else:
+            yield s
+
+
+class IsNumber(Term):
+    """ IsNumber(+Term)
+    Succeeds if Term is bound to an integer or floating point number.
+    """
+
+    deterministic = True
+
+    def __call__(self, s):
+        for n in self.args:
+            if not isinstance(s[n], (int, long, float)):
+                break
+        else:
+            yield s
+
+class IsAtom(Term):
     """ IsAtom(+Term)
     Succeeds if Term is bound to an atom.
     """
 
+    deterministic = True
+
     def __call__(self, s):
         for a in self.args:
             if not isinstance(s[a], (str, int, long, float)):
@@ -359,6 +1711,8 @@ class IsString(Term):
     """ IsString(+Term)
     Succeeds if Term is bound to a string.
     """
+
+    deterministic = True
     
     def __call__(self, s):
         for st in self.args:
@@ -373,6 +1727,8 @@ class IsCompound(Term):
     Succeeds if Term is bound to a compound term. See also functor/3 and =../2.
     """
 
+    deterministic = True
+
     def __call__(self, s):
         for t in self.args:
             t = s[t]
@@ -391,6 +1747,8 @@ class IsGround(Term):
     Succeeds if Term holds no free variables.
     """
 
+    deterministic = True
+
     def __call__(self, s):
         for t in self.args:
             ts = set([t])
@@ -401,9 +1759,10 @@ class IsGround(Term):
                     seen.add(t)
                     if isinstance(t, Var):
                         return
-                    if isinstance(t, Term):
-                        for arg in t.args:
-                            ts.add(arg)
+                    if isinstance(t, Term) and t._hash is None:
+                        for arg in _children(t):
+                            if isinstance(arg, Term):
+                                ts.add(arg)
         yield s
 
 class IsCyclic(Term):
@@ -411,40 +1770,22 @@ class IsCyclic(Term):
     Succeeds if Term contains cycles, i.e. is an infinite term. See also acyclic_term/1 and section 2.16. (24)
     """
 
+    deterministic = True
+
     def __call__(self, s):
-        for t in self.args:
-            seen = set()
-            ts = set([t])
-            while ts:
-                t = s[ts.pop()]
-                if t in seen:
-                    break
-                if isinstance(t, Term) and not isinstance(t, Var):
-                    seen.add(t)
-                    for arg in t.args:
-                        ts.add(arg)
-            else:
-                return
-        yield s
+        if not s.acyclic(self.args):
+            yield s
 
 class IsAcyclic(Term):
     """ IsAcyclic(+Term)
     Succeeds if Term does not contain cycles, i.e. can be processed recursively in finite time. See also cyclic_term/1 and section 2.16.
     """
 
+    deterministic = True
+
     def __call__(self, s):
-        for t in self.args:
-            seen = set()
-            ts = set([t])
-            while ts:
-                t = s[ts.pop()]
-                if t in seen:
-                    return
-                if isinstance(t, Term) and not isinstance(t, Var):
-                    seen.add(t)
-                    for arg in t.args:
-                        ts.add(arg)
-        yield s
+        if s.acyclic(self.args):
+            yield s
 
 # Comparison and Unification or Terms
 
@@ -464,6 +1805,8 @@ class Unify(Term):
     Unify Term1 with Term2. Succeeds if the unification succeeds.
     """
 
+    deterministic = True
+
     def __call__(self, s):
         return s.unify(*self.args)
 
@@ -472,22 +1815,35 @@ class UnifyWithOccursCheck(Term):
     As =/2, but using sound-unification. That is, a variable only unifies to a term if this term does not contain the variable itself.
     """
 
+    deterministic = True
+
     def __call__(self, s):
         return s.unify_with_occurs_check(*self.args)
 
-class _Comp:
+class _Comp(object):
+    __slots__ = ()
+
     def _cmp(self, s, a, b):
-        if isinstance(a, Term): return a.cmp(b, s)
-        elif isinstance(b, Term): return -b.cmp(a, s)
-        return cmp(a, b)
+        return _compare(a, b, s)
+
+    def _eq(self, s, a, b):
+        a = s[a]
+        b = s[b]
+        if a is b: return True
+        if isinstance(a, Term) and isinstance(b, Term) and a._hash is not None and b._hash is not None:
+            if a._hash != b._hash: return False
+            return _ground_eq(a, b)
+        return self._cmp(s, a, b) == 0
 
 class Eq(Term2, _Comp):
     """ +Term1 == +Term2
     Succeeds if Term1 is equivalent to Term2. A variable is only identical to a sharing variable.
     """
 
+    deterministic = True
+
     def __call__(self, s):
-        if self._cmp(s, *self.args) == 0:
+        if self._eq(s, *self.args):
             yield s
 
 class Ne(Term2, _Comp):
@@ -495,8 +1851,10 @@ class Ne(Term2, _Comp):
     Equivalent to \+Term1 == Term2.
     """
 
+    deterministic = True
+
     def __call__(self, s):
-        if self._cmp(s, *self.args) != 0:
+        if not self._eq(s, *self.args):
             yield s
 
 class Lt(Term2, _Comp):
@@ -504,6 +1862,8 @@ class Lt(Term2, _Comp):
     Succeeds if Term1 is before Term2 in the standard order of terms.
     """
 
+    deterministic = True
+
     def __call__(self, s):
         if self._cmp(s, *self.args) < 0:
             yield s
@@ -513,6 +1873,8 @@ class Le(Term2, _Comp):
     Succeeds if both terms are equal (==/2) or Term1 is before Term2 in the standard order of terms.
     """
 
+    deterministic = True
+
     def __call__(self, s):
         if self._cmp(s, *self.args) <= 0:
             yield s
@@ -522,6 +1884,8 @@ class Gt(Term2, _Comp):
     Succeeds if Term1 is after Term2 in the standard order of terms.
     """
 
+    deterministic = True
+
     def __call__(self, s):
         if self._cmp(s, *self.args) > 0:
             yield s
@@ -531,6 +1895,8 @@ class Ge(Term2, _Comp):
     Succeeds if both terms are equal (==/2) or Term1 is after Term2 in the standard order of terms.
     """
 
+    deterministic = True
+
     def __call__(self, s):
         if self._cmp(s, *self.args) >= 0:
             yield s
@@ -540,6 +1906,8 @@ class Compare(Term3, _Comp):
     Determine or test the Order between two terms in the standard order of terms. Order is one of <, > or =, with the obvious meaning.
     """
 
+    deterministic = True
+
     def __call__(self, s):
         order, term1, term2 = self.args
         o = self._cmp(s, term1, term2)
@@ -552,6 +1920,8 @@ class Unifiable(Term):
     If X and Y can unify, unify Unifier with a list of Var = Value, representing the bindings required to make X and Y equivalent. (26) This predicate can handle cyclic terms. Attributed variables are handles as normal variables. Associated hooks are not executed.
     """
 
+    deterministic = True
+
     def __call__(self, s):
         for su in Unify(*self.args[:-1])(s):
             unifier = nil
@@ -560,6 +1930,167 @@ class Unifiable(Term):
             for sunifier in Unify(self.args[-1], unifier)(s):
                 yield sunifier
 
+# Arithmetic
+
+class Succ(Term2):
+    """ Succ(?Int1, ?Int2)
+    True if Int2 = Int1 + 1 and Int1 >= 0. At least one of the arguments must be instantiated to a natural number.
+    """
+
+    deterministic = True
+
+    def __call__(self, s):
+        int1, int2 = self.args
+        n = s[int1]
+        if isinstance(n, (int, long)):
+            if n >= 0:
+                return s.unify(int2, n+1)
+        else:
+            n = s[int2]
+            if isinstance(n, (int, long)) and n > 0:
+                return s.unify(int1, n-1)
+        return iter(())
+
+# Sorting Lists
+
+def _sort_order(ts, s, reverse=False):
+    # stable permutation of the indexes of ts sorting the terms in the
+    # standard order, and a function telling whether the terms of two
+    # indexes are equal. Sort keys are compared unless one of the terms
+    # is cyclic (it has no key): the terms are then compared by _compare
+    order = range(len(ts))
+    try:
+        keys = [sort_key(t, s) for t in ts]
+    except ValueError:
+        order.sort(lambda i, j: _compare(ts[i], ts[j], s), reverse=reverse)
+        return order, lambda i, j: _compare(ts[i], ts[j], s) == 0
+    order.sort(key=keys.__getitem__, reverse=reverse)
+    return order, lambda i, j: keys[i] == keys[j]
+
+def _unique(items, order, equal):
+    # items in the given order, without consecutive equal items
+    result = [items[order[0]]]
+    for k in xrange(1, len(order)):
+        if not equal(order[k-1], order[k]):
+            result.append(items[order[k]])
+    return result
+
+# Order of Sort/4: (reverse, unique)
+_sort_orders = {Lt: (False, True), Le: (False, False), Gt: (True, True), Ge: (True, False)}
+
+class MSort(Term2):
+    """ MSort(+List, -Sorted)
+    Equivalent to Sort/2, but does not remove duplicates.
+    """
+
+    deterministic = True
+
+    def __call__(self, s):
+        List, Sorted = self.args
+        items = _list_items(List, s)
+        if items is None:
+            return iter(())
+        order, equal = _sort_order(items, s)
+        return s.unify(Sorted, _make_list([items[i] for i in order]))
+
+class Sort(Term):
+    """ Sort(+List, -Sorted)
+    True if Sorted can be unified with a list holding the elements of List, sorted to the standard order of terms. Duplicates are removed.
+
+    Sort(+Key, +Order, +List, -Sorted)
+    True when Sorted can be unified with a list holding the elements of List. Key determines which part of each element in List is used for comparing two term and Order describes the relation between each set of consecutive elements in Sorted. If Key is 0, the entire term is used, otherwise the Key-th argument. Order is one of Lt, Le, Gt or Ge; Lt and Gt remove duplicates. The sort is stable.
+    """
+
+    deterministic = True
+
+    def __call__(self, s):
+        if len(self.args) == 2:
+            Key, Order, (List, Sorted) = 0, Lt, self.args
+        else:
+            Key, Order, List, Sorted = self.args
+            Key = s[Key]
+            Order = s[Order]
+        items = _list_items(List, s)
+        if items is None or not isinstance(Key, (int, long)) or Key < 0:
+            return iter(())
+        try:
+            reverse, unique = _sort_orders[Order]
+        except KeyError:
+            return iter(())
+        if Key:
+            ts = []
+            for t in items:
+                t = s[t]
+                if not isinstance(t, Term) or isinstance(t, Var) or t.arity < Key:
+                    return iter(())
+                ts.append(t.args[Key-1])
+        else:
+            ts = items
+        order, equal = _sort_order(ts, s, reverse)
+        if unique and items:
+            items = _unique(items, order, equal)
+        else:
+            items = [items[i] for i in order]
+        return s.unify(Sorted, _make_list(items))
+
+class KeySort(Term2):
+    """ KeySort(+List, -Sorted)
+    Sort a list of pairs. List must be a list of pair(Key, Value) terms. KeySort/2 copies List to Sorted, ordering the pairs on their keys. The sort is stable.
+    """
+
+    deterministic = True
+
+    def __call__(self, s):
+        List, Sorted = self.args
+        items = _list_items(List, s)
+        if items is None:
+            return iter(())
+        ts = []
+        for t in items:
+            t = s[t]
+            if not isinstance(t, pair):
+                return iter(())
+            ts.append(t.args[0])
+        order, equal = _sort_order(ts, s)
+        return s.unify(Sorted, _make_list([items[i] for i in order]))
+
+class _PredSortFailed(Exception):
+    pass
+
+class PredSort(Term3):
+    """ PredSort(+Pred, +List, -Sorted)
+    Sorts similar to Sort/2, but determines the order of two terms by calling Pred(-Delta, +E1, +E2). This call must unify Delta with one of Lt, Gt or Eq. If built-in predicate Pred fails, PredSort/3 fails. If Delta is Eq, only one of the two elements is kept.
+    """
+
+    deterministic = True
+
+    def __call__(self, s):
+        Pred, List, Sorted = self.args
+        Pred = s[Pred]
+        items = _list_items(List, s)
+        if items is None:
+            return iter(())
+        def order(a, b):
+            Delta = Var()
+            for s1 in Pred(Delta, a, b)(s):
+                delta = s1[Delta]
+                break
+            else:
+                raise _PredSortFailed
+            if delta is Lt: return -1
+            if delta is Gt: return +1
+            if delta is Eq: return 0
+            raise _PredSortFailed
+        try:
+            items.sort(order)
+            result = items[:1]
+            for t in items[1:]:
+                if order(result[-1], t) != 0:
+                    result.append(t)
+        except _PredSortFailed:
+            return iter(())
+        return s.unify(Sorted, _make_list(result))
+
 # Control Predicates
 
 class fail(Term0):
@@ -599,28 +2130,101 @@ def _group(G, Class):
     else:
         return [G]
 
-class And(Term2):
-    """ +Goal1 , +Goal2
-    Conjunction. Succeeds if both `Goal1' and `Goal2' can be proved.
+def _flatten(goals, Class):
+    # goals where the nested Class terms are replaced by their goals
+    args = []
+    for G in goals:
+        args.extend(_group(G, Class))
+    return args
+
+def _conjunction(goals, s, barrier=None):
+    # solutions of the conjunction of goals. The goals are split into
+    # runs of deterministic goals (dets), each one following a goal
+    # that may have several solutions (heads, the first run follows no
+    # goal). Deterministic goals are run in a plain loop and are not
+    # backtracked into. gens is the stack of the generators of the
+    # heads that may have other solutions, and runs the stack of the
+    # indexes of the runs following them.
+    heads = [None]
+    dets = [[]]
+    for goal in goals:
+        if goal.deterministic:
+            dets[-1].append(goal)
+        else:
+            heads.append(goal)
+            dets.append([])
+    m = len(heads)
+    gens = []
+    runs = []
+    j = 0
+    while True:
+        for goal in dets[j]:
+            # run to its end rather than closed when dropped
+            s1 = None
+            for s1 in goal(s):
+                pass
+            if s1 is None:
+                break
+            s = s1
+        else:
+            j += 1
+            if j == m:
+                yield s
+            else:
+                gen = heads[j](s)
+                for s in gen:
+                    break
+                else:
+                    gen = None
+                if gen is not None:
+                    gens.append(gen)
+                    runs.append(j)
+                    continue
+        while gens:
+            for s in gens[-1]:
+                break
+            else:
+                if barrier is not None and barrier.cut:
+                    return
+                gens.pop()
+                runs.pop()
+                continue
+            j = runs[-1]
+            break
+        else:
+            return
+
+class And(Term):
+    """ +Goal1 , +Goal2, ...
+    Conjunction. Succeeds if all the goals can be proved.
+
+    Nested conjunctions are flattened (g1 & g2 & g3 is And(g1, g2, g3))
+    and the goals are run by a single loop instead of a generator per
+    binary conjunction, so long bodies do not nest generators. The cost
+    per solution is about that of binary conjunctions; the loop only
+    saves the nesting, which matters for bodies of many goals.
     """
 
+    def __init__(self, *goals):
+        Term.__init__(self, *_flatten(goals, And))
+
     def __call__(self, s):
-        for s0 in self.args[0](s):
-            for s1 in self.args[1](s0):
-                yield s1
+        return _conjunction(self.args, s)
 
-class Or(Term2):
-    """ +Goal1 ; +Goal2
-    Disjonction. Succeeds if one of `Goal1' and `Goal2' can be proved.
+class Or(Term):
+    """ +Goal1 ; +Goal2; ...
+    Disjonction. Succeeds if one of the goals can be proved.
+
+    Nested disjunctions are flattened as nested conjunctions are.
     """
 
+    def __init__(self, *goals):
+        Term.__init__(self, *_flatten(goals, Or))
+
     def __call__(self, s):
-        try:
-            for g in self.args:
-                for gs in g(s):
-                    yield gs
-        except CutException:
-            pass
+        for g in self.args:
+            for gs in g(s):
+                yield gs
 
 class IfThenElse(Term3):
     """ +Condition -> +Action; +Else
@@ -634,7 +2238,1908 @@ class IfThenElse(Term3):
         except StopIteration:
             return Else(s)
         else:
-            return Then(s_if)
+            return Then(s_if.squash(s))
+
+# Cut
+#
+# A cut in the body of a clause is renamed as _Cut(barrier) where the
+# barrier is created by the call of the predicate. Backtracking into
+# the cut sets barrier.cut and the conjunctions, disjunctions and
+# clauses between the cut and its predicate (renamed as _CutAnd,
+# _CutOr, with the same barrier) stop looking for other solutions
+# when they see it. No exception goes through the generators.
+
+class cut(Term0):
+    """ !
+    Cut. Discard all choice points created since entering the predicate in which the cut appears. In other words, commit to the clause in which the cut appears and discard choice points that have been created by goals to the left of the cut in the current clause. Meta calling is opaque to !/0. This implies that Goal in call(Goal) cannot cut the clause that called call/1.
+    """
+
+    def __call__(self, s):
+        # a cut outside of a clause has no choice point to discard
+        yield s
+
+cut = cut()
+
+class _Barrier(object):
+    """ Choice point barrier of a predicate call, set by its cuts
+
+    height is the number of choice points of the Solve machine when
+    the predicate was called.
+    """
+
+    __slots__ = ('cut', 'height')
+
+    def __init__(self, height=0):
+        self.cut = False
+        self.height = height
+
+class _Cut(Term1):
+    """ Cut of a clause body (the argument is the barrier of the call) """
+
+    def __call__(self, s):
+        yield s
+        self.args[0].cut = True
+
+class _CutAnd(Term):
+    """ Conjunction containing a cut (the last argument is the barrier) """
+
+    def __call__(self, s):
+        return _conjunction(self.args[:-1], s, self.args[-1])
+
+class _CutOr(Term):
+    """ Disjunction containing a cut (the last argument is the barrier) """
+
+    def __call__(self, s):
+        barrier = self.args[-1]
+        for goal in self.args[:-1]:
+            for s1 in goal(s):
+                yield s1
+            if barrier.cut:
+                return
+
+def _bind_cuts(body, barrier):
+    # body where the cuts are replaced by _Cut(barrier), and the
+    # control constructs containing them by their barrier aware
+    # version (the condition of an if-then-else is opaque to cut)
+    memo = {}
+    todo = [(body, False)]
+    while todo:
+        t, done = todo.pop()
+        if t is cut:
+            memo[id(t)] = _Cut(barrier)
+        elif isinstance(t, (And, Or, IfThenElse)):
+            if isinstance(t, IfThenElse):
+                args = t.args[1:]
+            else:
+                args = t.args
+            if not done:
+                todo.append((t, True))
+                for a in args:
+                    todo.append((a, False))
+                continue
+            for a in args:
+                if id(a) in memo:
+                    break
+            else:
+                continue
+            if isinstance(t, And):
+                memo[id(t)] = _CutAnd(*[memo.get(id(a), a) for a in args] + [barrier])
+            elif isinstance(t, Or):
+                memo[id(t)] = _CutOr(*[memo.get(id(a), a) for a in args] + [barrier])
+            else:
+                # the condition is kept as is, even if it shares its
+                # terms (cut is a single object) with the branches
+                then, other = [memo.get(id(a), a) for a in args]
+                memo[id(t)] = IfThenElse(t.args[0], then, other)
+    return memo.get(id(body), body)
+
+# Predicates
+
+def _term_vars(terms):
+    # variables of terms, in order of first occurrence
+    result = []
+    seen = set()
+    todo = list(terms)
+    todo.reverse()
+    while todo:
+        t = todo.pop()
+        if isinstance(t, Var):
+            if id(t) not in seen:
+                seen.add(id(t))
+                result.append(t)
+        elif isinstance(t, Term) and t._hash is None and id(t) not in seen:
+            seen.add(id(t))
+            args = _children(t)
+            for i in xrange(len(args)-1, -1, -1):
+                todo.append(args[i])
+    return result
+
+_compound_key = object()
+
+def _index_key(t):
+    # key of an index: None for variables (and unhashable atoms), the
+    # functor of compound terms, or the value of atoms (atoms that
+    # unify, like 1 and 1.0, have the same key)
+    if isinstance(t, Var):
+        return None
+    if isinstance(t, Term):
+        return (_compound_key, t.functor, t.arity)
+    try:
+        hash(t)
+    except TypeError:
+        return None
+    return t
+
+# key of the clauses that can not match the calls using an index
+_no_match = object()
+
+def _then(ss, body):
+    for s1 in ss:
+        for s2 in body(s1):
+            yield s2
+
+def _then_compiled(ss, body, env):
+    det, f = body
+    for s1 in ss:
+        if det:
+            s2 = f(s1, env)
+            if s2 is not None:
+                yield s2
+        else:
+            for s2 in f(s1, env):
+                yield s2
+
+class _Clause(object):
+    """ Clause of a predicate: head :- body """
+
+    __slots__ = ('head', 'body', 'vars', 'barrier', 'code', 'ordinal')
+
+    def __init__(self, head, body):
+        barrier = Var('_B')
+        body2 = _bind_cuts(body, barrier)
+        if body2 is body:
+            barrier = None
+        self.head = head
+        self.body = body2
+        self.vars = _term_vars((head, body2))
+        self.barrier = barrier
+        self.code = None
+        self.ordinal = 0
+
+    def key(self, path):
+        """ Key of the argument of the head at path (see _Index) """
+        args = self.head.args
+        if len(args) <= path[0]:
+            return _no_match
+        t = args[path[0]]
+        if len(path) > 1:
+            if isinstance(t, Var):
+                return None
+            if not isinstance(t, Term) or t.functor is not path[1] or t.arity != path[2]:
+                return _no_match
+            t = t.args[path[3]]
+        return _index_key(t)
+
+    def compile(self):
+        """ Closures of the clause (see compile_goal)
+
+        Returns the builders of the head and of the body, the compiled
+        body, all functions of an environment holding the fresh
+        variables of the clause (see env), the slot of the barrier of
+        its cuts and the size of the environment. Returns False if the
+        clause can not be compiled (cyclic terms).
+        """
+        code = self.code
+        if code is None:
+            if _no_bindings.acyclic((self.head, self.body)):
+                slots = {}
+                for i in xrange(len(self.vars)):
+                    slots[id(self.vars[i])] = i
+                cache = [len(self.vars)]
+                body = _compile(self.body, slots, cache)
+                code = (_builder(self.head, slots), _builder(self.body, slots),
+                        body, slots.get(id(self.barrier)), cache[0])
+            else:
+                code = False
+            self.code = code
+        return code
+
+    def env(self, barrier=None):
+        """ Fresh variables of a compiled clause, by slot, followed by
+        the empty cache slots """
+        env = [Var(v.name) for v in self.vars]
+        env.extend([None] * (self.code[4] - len(env)))
+        slot = self.code[3]
+        if slot is not None:
+            if barrier is None:
+                barrier = _Barrier()
+            env[slot] = barrier
+        return env
+
+    def rename(self, barrier=None, compiled=False):
+        """ Head and body of the clause with fresh variables
+
+        The cuts of the clause set barrier (or a new barrier when the
+        clause is the only one tried). A compiled clause is renamed by
+        its builders.
+        """
+        head = self.head
+        body = self.body
+        if compiled and self.vars and self.compile():
+            env = self.env(barrier)
+            return self.code[0](env), self.code[1](env)
+        if self.vars:
+            memo = {}
+            for v in self.vars:
+                memo[id(v)] = Var(v.name)
+            if self.barrier is not None:
+                if barrier is None:
+                    barrier = _Barrier()
+                memo[id(self.barrier)] = barrier
+            head = _copy(head, _no_bindings, memo)
+            body = _copy(body, _no_bindings, memo)
+        return head, body
+
+    def solve(self, goal, s, barrier=None):
+        """ Solutions of goal with a renamed copy of the clause """
+        if goal.compiled and self.vars and self.compile():
+            env = self.env(barrier)
+            ss = s.unify(goal, self.code[0](env))
+            if self.body is true:
+                return ss
+            return _then_compiled(ss, self.code[2], env)
+        head, body = self.rename(barrier)
+        if body is true:
+            return s.unify(goal, head)
+        return _then(s.unify(goal, head), body)
+
+class _ClauseList(object):
+    """ Clauses in order, added at both ends
+
+    Clauses are never moved once added: the clauses added after the
+    others are appended to back, the clauses added before them to
+    front (in reverse order). Iterating on the list gives the clauses
+    it holds when the iteration starts, even if clauses are added
+    while it is in progress (logical update view).
+    """
+
+    __slots__ = ('front', 'back', 'size')
+
+    def __init__(self):
+        self.front = []
+        self.back = []
+        self.size = 0
+
+    def add(self, clause, first=False):
+        if first:
+            self.front.append(clause)
+        else:
+            self.back.append(clause)
+        self.size += 1
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        if self.front:
+            return chain(reversed(self.front), islice(self.back, len(self.back)))
+        return islice(self.back, self.size)
+
+def _merge(a, b):
+    # merges two iterators on clauses in the order of their ordinals
+    try:
+        y = b.next()
+    except StopIteration:
+        for x in a:
+            yield x
+        return
+    for x in a:
+        while y.ordinal < x.ordinal:
+            yield y
+            try:
+                y = b.next()
+            except StopIteration:
+                yield x
+                for x in a:
+                    yield x
+                return
+        yield x
+    yield y
+    for y in b:
+        yield y
+
+class _Index(object):
+    """ Hash index of the clauses of a predicate on one argument
+
+    The path of the argument is (i,) for the argument i of the head or
+    (i, functor, arity, j) for the argument j of the argument i when
+    it is a functor/arity term. The index maps the key of the argument
+    (see _index_key) to the list of clauses with this key. The clauses
+    with a variable at path (unindexed) may match every key: they are
+    kept in a single list, merged with the clauses of the key by
+    ordinal when the index is used. Clauses that can not match a call
+    using the index are left out.
+    """
+
+    __slots__ = ('path', 'index', 'unindexed', 'clauses', 'calls', 'selected')
+
+    def __init__(self, path, clauses):
+        self.path = path
+        self.index = {}
+        self.unindexed = _ClauseList()
+        self.clauses = 0
+        self.calls = 0
+        self.selected = 0
+        for clause in clauses:
+            self.add(clause)
+
+    def add(self, clause, first=False):
+        """ Adds clause after (or before) the clauses of the index """
+        self.clauses += 1
+        key = clause.key(self.path)
+        if key is _no_match:
+            return
+        if key is None:
+            bucket = self.unindexed
+        else:
+            bucket = self.index.get(key)
+            if bucket is None:
+                bucket = self.index[key] = _ClauseList()
+        bucket.add(clause, first)
+
+    def count(self, key):
+        """ Number of clauses that may match key """
+        bucket = self.index.get(key)
+        if bucket is None:
+            return self.unindexed.size
+        return bucket.size + self.unindexed.size
+
+    def get(self, key):
+        """ Iterator on the clauses that may match key """
+        bucket = self.index.get(key)
+        if bucket is None:
+            return iter(self.unindexed)
+        if not self.unindexed.size:
+            return iter(bucket)
+        return _merge(iter(bucket), iter(self.unindexed))
+
+    def stats(self):
+        path = self.path
+        if len(path) == 1:
+            argument = "%d"%(path[0]+1)
+        else:
+            argument = "%d.%s/%d.%d"%(path[0]+1, path[1].__name__, path[2], path[3]+1)
+        if self.calls:
+            selectivity = float(self.selected) / self.calls
+        else:
+            selectivity = None
+        return {
+            'argument': argument,
+            'clauses': self.clauses,
+            'keys': len(self.index),
+            'unindexed': len(self.unindexed),
+            'calls': self.calls,
+            'clauses per call': selectivity,
+        }
+
+class _Clauses(object):
+    """ Clauses of a predicate
+
+    Indexes are built just in time: the first call binding an argument
+    builds the index of this argument, and when the argument is bound
+    to a compound term matching several clauses, the indexes of the
+    bound arguments of this term. A call uses the index giving the
+    fewest clauses. The indexes are updated when a clause is added,
+    and the code of the bytecode machine (wam) is dropped.
+
+    Clauses are numbered in their order (ordinal): asserta numbers
+    them downwards from 0, assertz upwards. They are added in place to
+    lists of clauses that never move them (see _ClauseList), so a call
+    in progress keeps on iterating on the clauses it has selected.
+    """
+
+    __slots__ = ('clauses', 'indexes', 'wam', 'first', 'last')
+
+    def __init__(self):
+        self.clauses = _ClauseList()
+        self.indexes = {}
+        self.wam = None
+        self.first = 0
+        self.last = 0
+
+    def add(self, clause, first=False):
+        if first:
+            self.first -= 1
+            clause.ordinal = self.first
+        else:
+            self.last += 1
+            clause.ordinal = self.last
+        self.clauses.add(clause, first)
+        for index in self.indexes.itervalues():
+            index.add(clause, first)
+        if self.wam is not None:
+            self.wam.code = None
+
+    def index(self, path):
+        index = self.indexes.get(path)
+        if index is None:
+            index = self.indexes[path] = _Index(path, self.clauses)
+        return index
+
+    def select(self, goal, s):
+        """ Number of clauses that may match goal and iterator on them """
+        count = self.clauses.size
+        if count < 2 or not goal.indexing:
+            return count, iter(self.clauses)
+        best_index = best_key = None
+        args = goal.args
+        for i in xrange(len(args)):
+            a = s[args[i]]
+            key = _index_key(a)
+            if key is None:
+                continue
+            index = self.index((i,))
+            n = index.count(key)
+            if n < count:
+                count, best_index, best_key = n, index, key
+            if n > 1 and isinstance(a, Term):
+                # deep indexing on the arguments of a
+                for j in xrange(len(a.args)):
+                    key = _index_key(s[a.args[j]])
+                    if key is None:
+                        continue
+                    index = self.index((i, a.functor, a.arity, j))
+                    n = index.count(key)
+                    if n < count:
+                        count, best_index, best_key = n, index, key
+            if count < 2:
+                break
+        if best_index is None:
+            return count, iter(self.clauses)
+        best_index.calls += 1
+        best_index.selected += count
+        return count, best_index.get(best_key)
+
+class Predicate(Term):
+    """ Base class for predicates defined by clauses
+
+        class likes(Predicate): pass
+        likes.assertz(likes('sam', Food), indian(Food) & mild(Food))
+        likes.assertz(likes('sam', 'chips'))
+
+    A call tries the clauses in order, each clause being renamed (its
+    variables replaced by fresh ones) before its head is unified with
+    the goal. When arguments of the goal are bound, only the clauses
+    that may match them according to the indexes of the predicate are
+    tried (see _Clauses), and a call matching a single clause leaves
+    no choice point.
+
+    The clauses of a predicate whose compiled attribute is true are
+    compiled into closures (see compile_goal) the first time they are
+    used: renaming a clause then builds its terms directly instead of
+    copying them and the body is run without walking its goal tree.
+
+    A call of a predicate whose wam attribute is true is solved by the
+    bytecode machine (see Wam), as are the predicates it calls. Setting
+    it on a base class of the predicates of a program switches the
+    whole program to the machine.
+    """
+
+    indexing = True
+    compiled = False
+    wam = False
+
+    def clauses(cls):
+        clauses = cls.__dict__.get('_clauses')
+        if clauses is None:
+            clauses = _Clauses()
+            setattr(cls, '_clauses', clauses)
+        return clauses
+    clauses = classmethod(clauses)
+
+    def assertz(cls, head, body=true):
+        """ Adds the clause head :- body after the clauses of the predicate """
+        cls.clauses().add(_Clause(head, body))
+    assertz = classmethod(assertz)
+
+    def asserta(cls, head, body=true):
+        """ Adds the clause head :- body before the clauses of the predicate """
+        cls.clauses().add(_Clause(head, body), first=True)
+    asserta = classmethod(asserta)
+
+    def index_stats(cls):
+        """ Statistics of the indexes built for the predicate
+
+        One dict per index giving the indexed argument ('2' for the
+        second argument, '1.f/2.2' for the second argument of an f/2
+        first argument), the number of clauses, of distinct keys and of
+        clauses with a variable (selected for every key), the number of
+        calls that used the index and the average number of clauses
+        they selected.
+        """
+        indexes = cls.clauses().indexes.values()
+        indexes.sort(key=lambda index: index.path)
+        return [index.stats() for index in indexes]
+    index_stats = classmethod(index_stats)
+
+    def __call__(self, s):
+        if self.wam:
+            return _wam_solve(_wam_proc(self.__class__), self.args, s)
+        count, clauses = self.clauses().select(self, s)
+        if count == 1:
+            return clauses.next().solve(self, s)
+        return self.solve(clauses, s)
+
+    def solve(self, clauses, s):
+        barrier = _Barrier()
+        for clause in clauses:
+            for s1 in clause.solve(self, s, barrier):
+                yield s1
+            if barrier.cut:
+                return
+
+# Compilation of goals
+
+# A goal tree is compiled into nested closures with its arguments
+# bound in their cells. A compiled goal is a pair (det, f) where f is a
+# function of a stack and of an environment (the fresh variables of a
+# clause, indexed by slot). If det is true, f returns the solution or
+# None, otherwise it returns an iterator on the solutions. Terms are
+# compiled into builders: functions of the environment returning the
+# term where the variables of the clause are replaced by the fresh
+# ones (the other variables and the ground subterms are constants).
+# The terms built by the goals of a clause body are built once per
+# environment, in cache slots following the variables of the clause.
+
+def _constant(t):
+    return lambda env: t
+
+def _variable(i):
+    return lambda env: env[i]
+
+def _builder(t, slots):
+    # slots maps the ids of the variables of the clause to their slots
+    if not isinstance(t, Term) or t._hash is not None:
+        return _constant(t)
+    if isinstance(t, Var):
+        i = slots.get(id(t))
+        if i is None:
+            return _constant(t)
+        return _variable(i)
+    if not isinstance(t, plist):
+        for a in t.args:
+            if isinstance(a, Term) and a._hash is None and not isinstance(a, Var):
+                break
+        else:
+            # flat term
+            builders = [_builder(a, slots) for a in t.args]
+            def build(env):
+                obj = _clone(t)
+                args = obj.args = tuple([b(env) for b in builders])
+                obj._hash = _structural_hash(obj.functor, args)
+                return obj
+            return build
+    # nested term: a flat program run on a stack of terms, the
+    # arguments of a term being pushed before it
+    program = []
+    todo = [(t, False)]
+    while todo:
+        t, done = todo.pop()
+        if isinstance(t, plist):
+            children = t.packed.items[t.start:] + (t.packed.tail,)
+        elif isinstance(t, Term) and not isinstance(t, Var) and t._hash is None:
+            children = t.args
+        elif isinstance(t, Var) and id(t) in slots:
+            program.append((_B_VAR, slots[id(t)]))
+            continue
+        else:
+            program.append((_B_CONST, t))
+            continue
+        if done:
+            if isinstance(t, plist):
+                program.append((_B_LIST, len(children)))
+            else:
+                program.append((_B_TERM, t, len(children)))
+            continue
+        todo.append((t, True))
+        for i in xrange(len(children)-1, -1, -1):
+            todo.append((children[i], False))
+    def build(env):
+        stack = []
+        for op in program:
+            kind = op[0]
+            if kind == _B_VAR:
+                stack.append(env[op[1]])
+            elif kind == _B_CONST:
+                stack.append(op[1])
+            elif kind == _B_TERM:
+                n = len(stack) - op[2]
+                obj = _clone(op[1])
+                args = obj.args = tuple(stack[n:])
+                obj._hash = _structural_hash(obj.functor, args)
+                del stack[n:]
+                stack.append(obj)
+            else:
+                n = len(stack) - op[1]
+                obj = plist(stack[n:-1], stack[-1])
+                del stack[n:]
+                stack.append(obj)
+        return stack[0]
+    return build
+
+_B_VAR, _B_CONST, _B_TERM, _B_LIST = range(4)
+
+def _cached(t, slots, cache):
+    # builder of t building it once per environment, in the next cache
+    # slot (cache is [next slot], or None when there is no environment)
+    build = _builder(t, slots)
+    if cache is None or not isinstance(t, Term) or isinstance(t, Var) or t._hash is not None:
+        return build
+    k = cache[0]
+    cache[0] += 1
+    def cached(env):
+        t = env[k]
+        if t is None:
+            t = env[k] = build(env)
+        return t
+    return cached
+
+def _succeed(s, env):
+    return s
+
+def _fail(s, env):
+    return None
+
+def _first(code, s, env):
+    # first solution of a compiled goal or None
+    det, f = code
+    if det:
+        return f(s, env)
+    for s1 in f(s, env):
+        return s1
+    return None
+
+_comp = _Comp()
+
+_type_tests = {
+    IsVar: lambda t: isinstance(t, Var),
+    IsNonVar: lambda t: not isinstance(t, Var),
+    IsInteger: lambda t: isinstance(t, (int, long)),
+    IsFloat: lambda t: isinstance(t, float),
+    IsNumber: lambda t: isinstance(t, (int, long, float)),
+    IsAtom: lambda t: isinstance(t, (str, int, long, float)),
+    IsString: lambda t: isinstance(t, str),
+    IsCompound: lambda t: isinstance(t, Term) and not isinstance(t, Var),
+    IsCallable: lambda t: isinstance(t, Term) and not isinstance(t, Var),
+}
+
+_order_tests = {
+    Lt: lambda o: o < 0,
+    Le: lambda o: o <= 0,
+    Gt: lambda o: o > 0,
+    Ge: lambda o: o >= 0,
+}
+
+def _compile_and(code, barrier):
+    for det, f in code:
+        if not det:
+            break
+    else:
+        fs = [f for det, f in code]
+        def conjunction(s, env):
+            for f in fs:
+                s = f(s, env)
+                if s is None:
+                    return None
+            return s
+        return True, conjunction
+    heads = [None]
+    dets = [[]]
+    for det, f in code:
+        if det:
+            dets[-1].append(f)
+        else:
+            heads.append(f)
+            dets.append([])
+    m = len(heads)
+    def conjunction(s, env):
+        # same loop as _conjunction
+        if barrier is None:
+            b = None
+        else:
+            b = barrier(env)
+        gens = []
+        runs = []
+        j = 0
+        while True:
+            for f in dets[j]:
+                s1 = f(s, env)
+                if s1 is None:
+                    break
+                s = s1
+            else:
+                j += 1
+                if j == m:
+                    yield s
+                else:
+                    gen = heads[j](s, env)
+                    for s in gen:
+                        break
+                    else:
+                        gen = None
+                    if gen is not None:
+                        gens.append(gen)
+                        runs.append(j)
+                        continue
+            while gens:
+                for s in gens[-1]:
+                    break
+                else:
+                    if b is not None and b.cut:
+                        return
+                    gens.pop()
+                    runs.pop()
+                    continue
+                j = runs[-1]
+                break
+            else:
+                return
+    return False, conjunction
+
+def _compile_or(code, barrier):
+    def disjunction(s, env):
+        if barrier is None:
+            b = None
+        else:
+            b = barrier(env)
+        for det, f in code:
+            if det:
+                s1 = f(s, env)
+                if s1 is not None:
+                    yield s1
+            else:
+                for s1 in f(s, env):
+                    yield s1
+            if b is not None and b.cut:
+                return
+    return False, disjunction
+
+def _compile_if(cond, then, other):
+    if then[0] and other[0]:
+        def if_then_else(s, env):
+            s1 = _first(cond, s, env)
+            if s1 is None:
+                return other[1](s, env)
+            return then[1](s1.squash(s), env)
+        return True, if_then_else
+    def if_then_else(s, env):
+        s1 = _first(cond, s, env)
+        if s1 is None:
+            det, f = other
+        else:
+            det, f = then
+            s = s1.squash(s)
+        if det:
+            s1 = f(s, env)
+            if s1 is not None:
+                yield s1
+        else:
+            for s1 in f(s, env):
+                yield s1
+    return False, if_then_else
+
+def _compile(goal, slots, cache=None):
+    # compiled goal (det, f)
+    cls = goal.__class__
+    if goal is true or goal is cut:
+        return True, _succeed
+    if goal is fail:
+        return True, _fail
+    if cls is And or cls is _CutAnd:
+        goals = goal.args
+        barrier = None
+        if cls is _CutAnd:
+            goals = goals[:-1]
+            barrier = _builder(goal.args[-1], slots)
+        return _compile_and([_compile(g, slots, cache) for g in goals], barrier)
+    if cls is Or or cls is _CutOr:
+        goals = goal.args
+        barrier = None
+        if cls is _CutOr:
+            goals = goals[:-1]
+            barrier = _builder(goal.args[-1], slots)
+        return _compile_or([_compile(g, slots, cache) for g in goals], barrier)
+    if cls is IfThenElse:
+        return _compile_if(*[_compile(g, slots, cache) for g in goal.args])
+    if cls is Not:
+        code = _compile(goal.args[0], slots, cache)
+        def negation(s, env):
+            if _first(code, s, env) is None:
+                return s
+            return None
+        return True, negation
+    if cls is _Cut:
+        barrier = _builder(goal.args[0], slots)
+        def cut_barrier(s, env):
+            yield s
+            barrier(env).cut = True
+        return False, cut_barrier
+    if cls is Unify:
+        a, b = [_cached(t, slots, cache) for t in goal.args]
+        def unify(s, env):
+            for s1 in s.unify(a(env), b(env)):
+                return s1
+            return None
+        return True, unify
+    if cls in _type_tests:
+        test = _type_tests[cls]
+        builders = [_cached(t, slots, cache) for t in goal.args]
+        def type_test(s, env):
+            for b in builders:
+                if not test(s[b(env)]):
+                    return None
+            return s
+        return True, type_test
+    if cls is Eq or cls is Ne:
+        a, b = [_cached(t, slots, cache) for t in goal.args]
+        equal = cls is Eq
+        def identity(s, env):
+            if _comp._eq(s, a(env), b(env)) == equal:
+                return s
+            return None
+        return True, identity
+    if cls in _order_tests:
+        test = _order_tests[cls]
+        a, b = [_cached(t, slots, cache) for t in goal.args]
+        def order(s, env):
+            if test(_compare(a(env), b(env), s)):
+                return s
+            return None
+        return True, order
+    # other goals (predicates, builtins, variables) are built and called
+    build = _cached(goal, slots, cache)
+    if not isinstance(goal, Var) and goal.deterministic:
+        def call(s, env):
+            for s1 in build(env)(s):
+                return s1
+            return None
+        return True, call
+    def call(s, env):
+        return s[build(env)](s)
+    return False, call
+
+def compile_goal(goal):
+    """ Compiles goal into nested closures
+
+    compile_goal(goal)(s) yields the same solutions as goal(s) but the
+    goal tree is walked once: control constructs and simple builtins
+    (Unify, type tests, comparisons) become closures with their
+    arguments bound in their cells, and deterministic goals are plain
+    function calls instead of generators. Predicates with a true
+    compiled attribute compile their clauses the same way.
+    """
+    det, f = _compile(goal, {})
+    if det:
+        def run(s):
+            s1 = f(s, None)
+            if s1 is not None:
+                yield s1
+        return run
+    return lambda s: f(s, None)
+
+# Continuation based solver
+
+# Kinds of choice points of Solve
+_ALTERNATIVE, _GENERATOR, _CLAUSES = range(3)
+
+class Solve(Term1):
+    """ Solve(+Goal)
+    Solves Goal on a trampoline instead of nesting a generator per conjunction and per call. Goals left to prove are a linked list of continuations and choice points are kept on an explicit stack, so resuming a choice point costs O(1) whatever the depth of the proof and recursion is only limited by memory. Conjunctions, disjunctions, if-then-else, cut, true, fail, Unify, Rec and predicates are executed by the solver; deterministic goals are run in place and other goals are called as generators, each generator being a choice point.
+
+    A last call continues with the continuation of its caller and a call matching a last clause leaves no choice point, so a deterministic tail recursion only keeps its bindings. These are compacted when no choice point is left: the bindings that can not be reached from the goal and from the goals left to prove are dropped, so such loops run in constant memory. compaction is the minimal number of calls between two compactions (0 disables them).
+    """
+
+    compaction = 4096
+
+    def __call__(self, s):
+        return _solve(self.args[0], s, self.compaction)
+
+def _compact(s0, allocated, s, cont, qvars):
+    # Stack s0 extended with the bindings of s reachable from the
+    # variables qvars of the goal, and cont where the bound variables
+    # are replaced by their values. Also returns the number of terms
+    # copied, an estimate of the size of the live bindings.
+    memo = {}
+    goals = []
+    while cont is not None:
+        goal, cont = cont
+        goals.append(_copy(goal, s, memo))
+    values = [_copy(v, s, memo) for v in qvars]
+    s0 = s0.reclaim(allocated)
+    for i in xrange(len(qvars)):
+        if values[i] is not qvars[i]:
+            for s0 in s0.unify(qvars[i], values[i]):
+                break
+    goals.reverse()
+    for goal in goals:
+        cont = (goal, cont)
+    return s0, cont, len(memo)
+
+def _solve(goal, s, compaction=0):
+    # cont: goals left to prove, as (goal, cont) pairs (None: success)
+    # choices: stack of choice points
+    #   (_ALTERNATIVE, stack, cont)
+    #   [_GENERATOR, None, cont, generator]
+    #   [_CLAUSES, stack, cont, goal, clauses, clauses left, barrier]
+    # A cut removes the choice points above the height of its barrier.
+    # calls: calls made without choice points since the last compaction
+    cont = (goal, None)
+    choices = []
+    failed = False
+    if compaction:
+        start = s
+        allocated = s.allocated()
+        qvars = _term_vars((goal,))
+        calls = 0
+        limit = compaction
+    while True:
+        while cont is not None:
+            goal, cont = cont
+            goal = s[goal]
+            cls = goal.__class__
+            if cls is And:
+                for i in xrange(len(goal.args)-1, -1, -1):
+                    cont = (goal.args[i], cont)
+            elif cls is _CutAnd:
+                for i in xrange(len(goal.args)-2, -1, -1):
+                    cont = (goal.args[i], cont)
+            elif cls is Unify:
+                for s1 in s.unify(*goal.args):
+                    s = s1
+                    break
+                else:
+                    failed = True
+                    break
+            elif (isinstance(goal, Predicate) and not goal.wam) or cls is Rec:
+                if compaction and not choices:
+                    calls += 1
+                    if calls >= limit:
+                        s, cont, live = _compact(start, allocated, s, (goal, cont), qvars)
+                        goal, cont = cont
+                        calls = 0
+                        limit = max(compaction, 4*live)
+                if cls is Rec:
+                    cont = (goal.args[0](*goal.args[1:]), cont)
+                    continue
+                count, clauses = goal.clauses().select(goal, s)
+                if not count:
+                    failed = True
+                    break
+                barrier = _Barrier(len(choices))
+                choices.append([_CLAUSES, s, cont, goal, clauses, count, barrier])
+                failed = True
+                break
+            elif cls is Or or cls is _CutOr:
+                goals = goal.args
+                if cls is _CutOr:
+                    goals = goals[:-1]
+                if not goals:
+                    failed = True
+                    break
+                for i in xrange(len(goals)-1, 0, -1):
+                    choices.append((_ALTERNATIVE, s, (goals[i], cont)))
+                cont = (goals[0], cont)
+            elif cls is IfThenElse:
+                If, Then, Else = goal.args
+                barrier = _Barrier(len(choices))
+                choices.append((_ALTERNATIVE, s, (Else, cont)))
+                cont = (If, (_Cut(barrier), (Then, cont)))
+            elif cls is _Cut:
+                del choices[goal.args[0].height:]
+            elif goal is true or goal is cut:
+                pass
+            elif goal is fail:
+                failed = True
+                break
+            elif cls.deterministic:
+                for s1 in goal(s):
+                    s = s1
+                    break
+                else:
+                    failed = True
+                    break
+            else:
+                choices.append([_GENERATOR, None, cont, goal(s)])
+                failed = True
+                break
+        if not failed:
+            yield s
+        # backtracking to the last choice point
+        failed = True
+        while failed:
+            if not choices:
+                return
+            choice = choices[-1]
+            kind = choice[0]
+            if kind == _ALTERNATIVE:
+                choices.pop()
+                s = choice[1]
+                cont = choice[2]
+                failed = False
+            elif kind == _GENERATOR:
+                try:
+                    s = choice[3].next()
+                    cont = choice[2]
+                    failed = False
+                except StopIteration:
+                    choices.pop()
+            else:
+                _, s0, cont0, goal, clauses, count, barrier = choice
+                if count == 1:
+                    choices.pop()
+                else:
+                    choice[5] = count-1
+                head, body = clauses.next().rename(barrier, goal.compiled)
+                for s1 in s0.unify(goal, head):
+                    s = s1
+                    if body is true:
+                        cont = cont0
+                    else:
+                        cont = (body, cont0)
+                    failed = False
+                    break
+
+# Bytecode machine
+
+# Clauses are compiled into a list of instructions in the style of the
+# Warren Abstract Machine and run by a single dispatch loop (_wam_run).
+#
+# The heap is a list of cells:
+#   (_REF, address)         variable (unbound if the address is its own)
+#   (_STRUCT, address)      compound term whose functor cell is at address
+#   (_FUNCTOR, term, arity) functor cell followed by the argument cells
+#                           (term is a term of the functor, used to
+#                           build copies of the compound term, see
+#                           _clone)
+#   (_CONST, value)         atom or ground term, shared with the caller
+# Argument registers and environment slots hold heap addresses. All
+# the variables of a clause live on the heap (there are no unsafe
+# variables) and environments are lists [previous environment,
+# continuation, slots...].
+#
+# A choice point saves the machine registers, the top of the trail and
+# the top of the heap, which is truncated when backtracking. Only the
+# bindings of cells older than the last choice point are trailed.
+
+_REF, _STRUCT, _FUNCTOR, _CONST = range(4)
+
+# Instructions, (opcode, operands...)
+(_GET_VARIABLE, _GET_VALUE, _GET_CONSTANT, _GET_STRUCTURE,
+ _UNIFY_VARIABLE, _UNIFY_VALUE, _UNIFY_CONSTANT,
+ _PUT_VARIABLE, _PUT_VALUE, _PUT_CONSTANT, _PUT_STRUCTURE, _NEW_VARIABLE,
+ _ALLOCATE, _DEALLOCATE, _CALL, _EXECUTE, _PROCEED,
+ _TRY_ME_ELSE, _RETRY_ME_ELSE, _TRUST_ME,
+ _SWITCH, _TRY, _RETRY, _TRUST,
+ _GET_LEVEL, _CUT, _EQUAL, _BUILTIN, _BACKTRACK) = range(29)
+
+# functor of the cons cells of packed lists
+_cons = cons(nil, nil)
+
+class _WamProc(object):
+    """ Code of a predicate, or of an anonymous procedure made of the
+    alternatives of a disjunction, if-then-else or negation
+
+    The code of a predicate is compiled when it is first called and
+    dropped when the predicate is modified. It starts with a switch on
+    the key of the first argument (see _index_key) when the heads of
+    the clauses have different keys, jumping to the clauses matching
+    the key, or to the chain of all the clauses if the argument is
+    unbound.
+    """
+
+    __slots__ = ('name', 'predicate', 'code', 'registers')
+
+    def __init__(self, name, predicate=None, clauses=None):
+        self.name = name
+        self.predicate = predicate
+        self.code = None
+        self.registers = 0
+        if clauses is not None:
+            self.compile(clauses)
+
+    def compile(self, clauses=None):
+        if clauses is None:
+            clauses = [(c.head.args, c.body) for c in self.predicate.clauses().clauses]
+        compiler = _WamCompiler()
+        indexing = self.predicate is None or self.predicate.indexing
+        self.code = compiler.procedure(clauses, indexing)
+        self.registers = compiler.registers
+        return self.code
+
+def _wam_proc(predicate):
+    # procedure of a predicate class
+    clauses = predicate.clauses()
+    proc = clauses.wam
+    if proc is None:
+        proc = clauses.wam = _WamProc(predicate.__name__, predicate)
+    return proc
+
+def _wam_goals(goal):
+    # goals of a conjunction
+    cls = goal.__class__
+    if cls is And:
+        goals = goal.args
+    elif cls is _CutAnd:
+        goals = goal.args[:-1]
+    else:
+        return [goal]
+    result = []
+    for g in goals:
+        result.extend(_wam_goals(g))
+    return result
+
+def _wam_compound(t):
+    return isinstance(t, Term) and t._hash is None and not isinstance(t, Var)
+
+def _wam_functor(t):
+    # (template, arity) of a compound term
+    if isinstance(t, plist):
+        return _cons, 2
+    return t, len(t.args)
+
+class _WamCompiler(object):
+    """ Compiler of the clauses of a procedure """
+
+    def __init__(self):
+        self.registers = 0
+
+    def procedure(self, clauses, indexing=True):
+        if not clauses:
+            return [(_BACKTRACK,)]
+        arity = len(clauses[0][0])
+        keys = None
+        if indexing and arity and len(clauses) > 1:
+            keys = [_index_key(args[0]) for args, body in clauses]
+            for key in keys:
+                if key is not None:
+                    break
+            else:
+                keys = None
+        code = []
+        if keys is not None:
+            switch = [_SWITCH, None, None, 1]
+            code.append(switch)
+        choice = None
+        labels = []
+        for k in xrange(len(clauses)):
+            if len(clauses) > 1:
+                if choice is not None:
+                    choice[1] = len(code)
+                if k == 0:
+                    choice = [_TRY_ME_ELSE, None, arity]
+                elif k < len(clauses)-1:
+                    choice = [_RETRY_ME_ELSE, None]
+                else:
+                    choice = [_TRUST_ME]
+                code.append(choice)
+            labels.append(len(code))
+            args, body = clauses[k]
+            code.extend(self.clause(args, body))
+        if keys is not None:
+            # chains of the clauses matching each key, the default
+            # one for the keys of no clause
+            table = {}
+            for key in keys:
+                if key is not None and key not in table:
+                    table[key] = self.chain(code, [labels[k] for k in xrange(len(keys))
+                                                   if keys[k] is None or keys[k] == key], arity)
+            switch[1] = table
+            switch[2] = self.chain(code, [labels[k] for k in xrange(len(keys))
+                                          if keys[k] is None], arity)
+        return [tuple(i) for i in code]
+
+    def chain(self, code, labels, arity):
+        # label of the code trying the clauses at labels
+        if not labels:
+            code.append((_BACKTRACK,))
+            return len(code)-1
+        if len(labels) == 1:
+            return labels[0]
+        start = len(code)
+        code.append((_TRY, labels[0], arity))
+        for label in labels[1:-1]:
+            code.append((_RETRY, label))
+        code.append((_TRUST, labels[-1]))
+        return start
+
+    def slot(self, v):
+        y = self.slots.get(id(v))
+        if y is None:
+            y = self.slots[id(v)] = self.temp()
+        return y
+
+    def temp(self):
+        self.size += 1
+        return self.size + 1
+
+    def register(self, i):
+        if i >= self.registers:
+            self.registers = i+1
+        return i
+
+    def clause(self, args, body):
+        self.code = code = []
+        self.slots = {}
+        self.size = 0
+        self.seen = set()
+        allocate = [_ALLOCATE, 0]
+        code.append(allocate)
+        # levels of the cuts of the clause (not passed by a caller)
+        head_vars = set([id(v) for v in _term_vars(args)])
+        for g in self.cuts(body):
+            b = g.args[0]
+            if id(b) not in head_vars and id(b) not in self.seen:
+                self.seen.add(id(b))
+                code.append((_GET_LEVEL, self.slot(b)))
+        # head
+        temp = self.register(len(args))
+        for i in xrange(len(args)):
+            self.register(i)
+            self.get(args[i], i, temp)
+        # body
+        goals = _wam_goals(body)
+        last_call = False
+        for k in xrange(len(goals)):
+            last_call = self.goal(goals[k], k == len(goals)-1)
+        if not last_call:
+            code.append((_DEALLOCATE,))
+            code.append((_PROCEED,))
+        allocate[1] = self.size
+        allocate = tuple(allocate)
+        code[0] = allocate
+        return code
+
+    def cuts(self, goal):
+        # _Cut goals of a body
+        todo = [goal]
+        while todo:
+            g = todo.pop()
+            if isinstance(g, _Cut):
+                yield g
+            elif isinstance(g, (And, Or, _CutAnd, _CutOr, IfThenElse, Not)):
+                todo.extend(g.args)
+
+    def get(self, t, i, temp):
+        code = self.code
+        if isinstance(t, Var):
+            if id(t) in self.seen:
+                code.append((_GET_VALUE, self.slot(t), i))
+            else:
+                self.seen.add(id(t))
+                code.append((_GET_VARIABLE, self.slot(t), i))
+        elif not _wam_compound(t):
+            code.append((_GET_CONSTANT, t, i))
+        else:
+            # nested terms are unified through temporary slots once
+            # their enclosing term is unified
+            template, arity = _wam_functor(t)
+            code.append((_GET_STRUCTURE, template, arity, i))
+            nested = self.arguments(t)
+            while nested:
+                t, y = nested.pop(0)
+                template, arity = _wam_functor(t)
+                code.append((_PUT_VALUE, y, temp))
+                code.append((_GET_STRUCTURE, template, arity, temp))
+                nested.extend(self.arguments(t))
+
+    def arguments(self, t):
+        # unify instructions of the arguments of t, returns the nested
+        # compound terms and their temporary slots
+        nested = []
+        for a in t.args:
+            if _wam_compound(a):
+                y = self.temp()
+                self.code.append((_UNIFY_VARIABLE, y))
+                nested.append((a, y))
+            else:
+                self.unify(a)
+        return nested
+
+    def unify(self, t):
+        code = self.code
+        if isinstance(t, Var):
+            if id(t) in self.seen:
+                code.append((_UNIFY_VALUE, self.slot(t)))
+            else:
+                self.seen.add(id(t))
+                code.append((_UNIFY_VARIABLE, self.slot(t)))
+        else:
+            code.append((_UNIFY_CONSTANT, t))
+
+    def put(self, t, i, temp):
+        code = self.code
+        if isinstance(t, Var):
+            if id(t) in self.seen:
+                code.append((_PUT_VALUE, self.slot(t), i))
+            else:
+                self.seen.add(id(t))
+                code.append((_PUT_VARIABLE, self.slot(t), i))
+        elif not _wam_compound(t):
+            code.append((_PUT_CONSTANT, t, i))
+        else:
+            # the nested terms are built before the terms containing
+            # them, in temp, and saved in temporary slots
+            built = {}
+            todo = [(t, None)]
+            while todo:
+                u, args = todo.pop()
+                if id(u) in built:
+                    continue
+                if args is None:
+                    args = u.args
+                    todo.append((u, args))
+                    for a in args:
+                        if _wam_compound(a) and id(a) not in built:
+                            todo.append((a, None))
+                    continue
+                template, arity = _wam_functor(u)
+                if u is t:
+                    code.append((_PUT_STRUCTURE, template, arity, i))
+                else:
+                    code.append((_PUT_STRUCTURE, template, arity, temp))
+                for a in args:
+                    if id(a) in built:
+                        code.append((_UNIFY_VALUE, built[id(a)]))
+                    else:
+                        self.unify(a)
+                if u is not t:
+                    y = built[id(u)] = self.temp()
+                    code.append((_GET_VARIABLE, y, temp))
+
+    def call(self, proc, args, last):
+        temp = self.register(len(args))
+        for i in xrange(len(args)):
+            self.register(i)
+            self.put(args[i], i, temp)
+        if last:
+            self.code.append((_DEALLOCATE,))
+            self.code.append((_EXECUTE, proc))
+        else:
+            self.code.append((_CALL, proc))
+        return last
+
+    def auxiliary(self, name, goal, clauses, last):
+        # call of an anonymous procedure whose arguments are the
+        # variables of goal
+        vs = _term_vars((goal,))
+        proc = _WamProc(name, clauses=[(vs, body) for body in clauses])
+        self.registers = max(self.registers, proc.registers)
+        return self.call(proc, vs, last)
+
+    def goal(self, g, last):
+        # compiles g, returns True if it is a last call
+        code = self.code
+        cls = g.__class__
+        if isinstance(g, Predicate) and not isinstance(g, Var):
+            return self.call(_wam_proc(cls), g.args, last)
+        if g is true or g is cut:
+            return False
+        if g is fail:
+            code.append((_BACKTRACK,))
+            return False
+        if cls is _Cut:
+            code.append((_CUT, self.slot(g.args[0])))
+            return False
+        if cls is Unify:
+            temp = self.register(2)
+            self.put(g.args[0], self.register(0), temp)
+            self.put(g.args[1], self.register(1), temp)
+            code.append((_EQUAL,))
+            return False
+        if cls is Or or cls is _CutOr:
+            goals = g.args
+            if cls is _CutOr:
+                goals = goals[:-1]
+            return self.auxiliary('or', g, goals, last)
+        if cls is IfThenElse:
+            If, Then, Else = g.args
+            b = Var('_B')
+            return self.auxiliary('if', g, [And(If, _Cut(b), Then), Else], last)
+        if cls is Not:
+            b = Var('_B')
+            return self.auxiliary('not', g, [And(g.args[0], _Cut(b), fail), true], last)
+        # other goals are called with the terms of their variables
+        slots = []
+        for v in _term_vars((g,)):
+            if id(v) not in self.seen:
+                self.seen.add(id(v))
+                code.append((_NEW_VARIABLE, self.slot(v)))
+            slots.append((v, self.slot(v)))
+        det = not isinstance(g, Var) and g.deterministic
+        code.append((_BUILTIN, g, tuple(slots), det))
+        return False
+
+def _wam_deref(heap, a):
+    c = heap[a]
+    while c[0] == _REF and c[1] != a:
+        a = c[1]
+        c = heap[a]
+    return a
+
+def _wam_equal(x, y):
+    # unification of two constants
+    if isinstance(x, Term) or isinstance(y, Term):
+        return isinstance(x, Term) and isinstance(y, Term) and _comp._eq(_no_bindings, x, y)
+    return _unify_table[_tag.get(type(x), _OTHER)][_tag.get(type(y), _OTHER)] == _VALUE and x == y
+
+def _wam_unify(heap, trail, hb, a, b):
+    todo = [(a, b)]
+    seen = None
+    while todo:
+        a, b = todo.pop()
+        c = heap[a]
+        while c[0] == _REF and c[1] != a:
+            a = c[1]
+            c = heap[a]
+        d = heap[b]
+        while d[0] == _REF and d[1] != b:
+            b = d[1]
+            d = heap[b]
+        if a == b:
+            continue
+        if c[0] == _REF:
+            if d[0] == _REF and b > a:
+                # the youngest variable is bound to the oldest
+                if b < hb: trail.append(b)
+                heap[b] = (_REF, a)
+            else:
+                if a < hb: trail.append(a)
+                if d[0] == _REF:
+                    heap[a] = (_REF, b)
+                else:
+                    heap[a] = d
+        elif d[0] == _REF:
+            if b < hb: trail.append(b)
+            heap[b] = c
+        elif c[0] == _STRUCT and d[0] == _STRUCT:
+            f = heap[c[1]]
+            g = heap[d[1]]
+            if f[2] != g[2] or f[1].functor is not g[1].functor:
+                return False
+            # pairs of compound terms already met (rational trees)
+            if seen is None:
+                seen = set()
+            key = (c[1], d[1])
+            if key in seen:
+                continue
+            seen.add(key)
+            for i in xrange(f[2]):
+                todo.append((c[1]+1+i, d[1]+1+i))
+        elif c[0] == _STRUCT or d[0] == _STRUCT:
+            # a ground term against a compound term of the heap
+            if c[0] == _STRUCT:
+                c, d = d, c
+            f = heap[d[1]]
+            t = c[1]
+            if not isinstance(t, Term) or t.functor is not f[1].functor or len(t.args) != f[2]:
+                return False
+            h = len(heap)
+            for x in t.args:
+                heap.append((_CONST, x))
+            for i in xrange(f[2]):
+                todo.append((h+i, d[1]+1+i))
+        elif not _wam_equal(c[1], d[1]):
+            return False
+    return True
+
+def _wam_get_constant(heap, trail, hb, a, value):
+    a = _wam_deref(heap, a)
+    c = heap[a]
+    if c[0] == _REF:
+        if a < hb: trail.append(a)
+        heap[a] = (_CONST, value)
+        return True
+    if c[0] == _CONST:
+        return _wam_equal(c[1], value)
+    h = len(heap)
+    heap.append((_CONST, value))
+    return _wam_unify(heap, trail, hb, a, h)
+
+def _wam_encode(heap, t, s, varmap):
+    # address of a copy of t (dereferenced in s if s is not None) on
+    # the heap, varmap maps the ids of the variables to (variable,
+    # address)
+    out = []
+    todo = [(t, None)]
+    memo = {}
+    while todo:
+        t, h = todo.pop()
+        if h is not None:
+            # the arguments of t are encoded
+            template, arity = _wam_functor(t)
+            args = out[-arity:]
+            del out[-arity:]
+            f = len(heap)
+            heap.append((_FUNCTOR, template, arity))
+            for a in args:
+                c = heap[a]
+                if c is None or c[0] == _REF:
+                    # variable or enclosing term of a cycle
+                    heap.append((_REF, a))
+                else:
+                    heap.append(c)
+            heap[h] = (_STRUCT, f)
+            out.append(h)
+            continue
+        if s is not None:
+            t = s[t]
+        if isinstance(t, Var):
+            v = varmap.get(id(t))
+            if v is None:
+                a = len(heap)
+                heap.append((_REF, a))
+                v = varmap[id(t)] = (t, a)
+            out.append(v[1])
+        elif not isinstance(t, Term) or t._hash is not None:
+            out.append(len(heap))
+            heap.append((_CONST, t))
+        elif id(t) in memo:
+            out.append(memo[id(t)])
+        else:
+            h = memo[id(t)] = len(heap)
+            heap.append(None)
+            todo.append((t, h))
+            args = t.args
+            for i in xrange(len(args)-1, -1, -1):
+                todo.append((args[i], None))
+    return out[0]
+
+def _wam_decode(heap, a, memo):
+    # term of the heap at a, memo maps the addresses of the unbound
+    # variables and of the functor cells to their terms
+    out = []
+    todo = [(a, None)]
+    while todo:
+        a, t = todo.pop()
+        if t is not None:
+            # the arguments of t are decoded
+            n = heap[a][2]
+            args = out[-n:]
+            del out[-n:]
+            t.args = tuple(args)
+            t._hash = _structural_hash(t.functor, t.args)
+            out.append(t)
+            continue
+        c = heap[a]
+        while c[0] == _REF and c[1] != a:
+            a = c[1]
+            c = heap[a]
+        if c[0] == _CONST:
+            out.append(c[1])
+        elif c[0] == _REF:
+            v = memo.get(a)
+            if v is None:
+                v = memo[a] = Var()
+            out.append(v)
+        else:
+            f = c[1]
+            t = memo.get(f)
+            if t is not None:
+                out.append(t)
+                continue
+            t = memo[f] = _clone(heap[f][1])
+            todo.append((f, t))
+            for i in xrange(f + heap[f][2], f, -1):
+                todo.append((i, None))
+    return out[0]
+
+def _wam_answer(heap, trail, hb, s, memo):
+    # unifies the variables decoded in memo with their values in s
+    varmap = {}
+    for a, v in memo.items():
+        if isinstance(v, Var):
+            varmap[id(v)] = (v, a)
+    for v, a in varmap.values():
+        t = s(v)
+        if t is v:
+            continue
+        if not _wam_unify(heap, trail, hb, a, _wam_encode(heap, t, None, varmap)):
+            return False
+    return True
+
+def _wam_run(proc, heap, args):
+    # Runs the call of proc with the arguments at the addresses args,
+    # yields each time it succeeds (the heap holds the solution until
+    # the next iteration)
+    code = proc.code
+    if code is None:
+        code = proc.compile()
+    A = list(args) + [None]*proc.registers
+    trail = []
+    choices = []
+    E = None
+    CP = None
+    B0 = 0
+    HB = 0
+    S = 0
+    write = False
+    pc = 0
+    while True:
+        instr = code[pc]
+        op = instr[0]
+        if op == _GET_VARIABLE:
+            E[instr[1]] = A[instr[2]]
+            pc += 1
+            continue
+        elif op == _GET_VALUE:
+            if _wam_unify(heap, trail, HB, E[instr[1]], A[instr[2]]):
+                pc += 1
+                continue
+        elif op == _GET_CONSTANT:
+            if _wam_get_constant(heap, trail, HB, A[instr[2]], instr[1]):
+                pc += 1
+                continue
+        elif op == _GET_STRUCTURE:
+            _, template, arity, i = instr
+            a = A[i]
+            c = heap[a]
+            while c[0] == _REF and c[1] != a:
+                a = c[1]
+                c = heap[a]
+            if c[0] == _REF:
+                f = len(heap)
+                heap.append((_FUNCTOR, template, arity))
+                if a < HB: trail.append(a)
+                heap[a] = (_STRUCT, f)
+                write = True
+                pc += 1
+                continue
+            elif c[0] == _STRUCT:
+                f = heap[c[1]]
+                if f[2] == arity and f[1].functor is template.functor:
+                    S = c[1] + 1
+                    write = False
+                    pc += 1
+                    continue
+            else:
+                t = c[1]
+                if isinstance(t, Term) and t.functor is template.functor and len(t.args) == arity:
+                    S = len(heap)
+                    for x in t.args:
+                        heap.append((_CONST, x))
+                    write = False
+                    pc += 1
+                    continue
+        elif op == _UNIFY_VARIABLE:
+            if write:
+                E[instr[1]] = h = len(heap)
+                heap.append((_REF, h))
+            else:
+                E[instr[1]] = S
+                S += 1
+            pc += 1
+            continue
+        elif op == _UNIFY_VALUE:
+            if write:
+                heap.append((_REF, E[instr[1]]))
+                pc += 1
+                continue
+            S += 1
+            if _wam_unify(heap, trail, HB, E[instr[1]], S-1):
+                pc += 1
+                continue
+        elif op == _UNIFY_CONSTANT:
+            if write:
+                heap.append((_CONST, instr[1]))
+                pc += 1
+                continue
+            S += 1
+            if _wam_get_constant(heap, trail, HB, S-1, instr[1]):
+                pc += 1
+                continue
+        elif op == _PUT_VARIABLE:
+            E[instr[1]] = A[instr[2]] = h = len(heap)
+            heap.append((_REF, h))
+            pc += 1
+            continue
+        elif op == _PUT_VALUE:
+            A[instr[2]] = E[instr[1]]
+            pc += 1
+            continue
+        elif op == _NEW_VARIABLE:
+            E[instr[1]] = h = len(heap)
+            heap.append((_REF, h))
+            pc += 1
+            continue
+        elif op == _PUT_CONSTANT:
+            A[instr[2]] = len(heap)
+            heap.append((_CONST, instr[1]))
+            pc += 1
+            continue
+        elif op == _PUT_STRUCTURE:
+            _, template, arity, i = instr
+            A[i] = h = len(heap)
+            heap.append((_STRUCT, h+1))
+            heap.append((_FUNCTOR, template, arity))
+            write = True
+            pc += 1
+            continue
+        elif op == _ALLOCATE:
+            E = [E, CP] + [None]*instr[1]
+            pc += 1
+            continue
+        elif op == _DEALLOCATE:
+            CP = E[1]
+            E = E[0]
+            pc += 1
+            continue
+        elif op == _CALL or op == _EXECUTE:
+            if op == _CALL:
+                CP = (code, pc+1)
+            proc = instr[1]
+            code = proc.code
+            if code is None:
+                code = proc.compile()
+            if proc.registers > len(A):
+                A.extend([None]*(proc.registers-len(A)))
+            B0 = len(choices)
+            pc = 0
+            continue
+        elif op == _PROCEED:
+            if CP is not None:
+                code, pc = CP
+                continue
+            yield True
+        elif op == _TRY_ME_ELSE:
+            choices.append([code, instr[1], A[:instr[2]], E, CP, len(trail), len(heap), B0, None, None])
+            HB = len(heap)
+            pc += 1
+            continue
+        elif op == _RETRY_ME_ELSE:
+            choices[-1][1] = instr[1]
+            pc += 1
+            continue
+        elif op == _TRUST_ME:
+            choices.pop()
+            if choices:
+                HB = choices[-1][6]
+            else:
+                HB = 0
+            pc += 1
+            continue
+        elif op == _SWITCH:
+            a = A[0]
+            c = heap[a]
+            while c[0] == _REF and c[1] != a:
+                a = c[1]
+                c = heap[a]
+            if c[0] == _REF:
+                pc = instr[3]
+                continue
+            if c[0] == _STRUCT:
+                f = heap[c[1]]
+                key = (_compound_key, f[1].functor, f[2])
+            else:
+                key = _index_key(c[1])
+                if key is None:
+                    pc = instr[3]
+                    continue
+            pc = instr[1].get(key, instr[2])
+            continue
+        elif op == _TRY:
+            choices.append([code, pc+1, A[:instr[2]], E, CP, len(trail), len(heap), B0, None, None])
+            HB = len(heap)
+            pc = instr[1]
+            continue
+        elif op == _RETRY:
+            choices[-1][1] = pc+1
+            pc = instr[1]
+            continue
+        elif op == _TRUST:
+            choices.pop()
+            if choices:
+                HB = choices[-1][6]
+            else:
+                HB = 0
+            pc = instr[1]
+            continue
+        elif op == _GET_LEVEL:
+            E[instr[1]] = len(heap)
+            heap.append((_CONST, B0))
+            pc += 1
+            continue
+        elif op == _CUT:
+            level = heap[_wam_deref(heap, E[instr[1]])][1]
+            if len(choices) > level:
+                del choices[level:]
+                if choices:
+                    HB = choices[-1][6]
+                else:
+                    HB = 0
+            pc += 1
+            continue
+        elif op == _EQUAL:
+            if _wam_unify(heap, trail, HB, A[0], A[1]):
+                pc += 1
+                continue
+        elif op == _BUILTIN:
+            # the goal is run on a stack binding its variables to their terms
+            _, goal, slots, det = instr
+            memo = {}
+            s = Stack()
+            for v, y in slots:
+                s[v] = _wam_decode(heap, E[y], memo)
+            solutions = s[goal](s)
+            if det:
+                for s in solutions:
+                    if _wam_answer(heap, trail, HB, s, memo):
+                        pc += 1
+                        break
+                else:
+                    s = None
+                if s is not None:
+                    continue
+            else:
+                choices.append([code, pc+1, (), E, CP, len(trail), len(heap), B0, solutions, memo])
+                HB = len(heap)
+        # backtracking to the last choice point
+        while choices:
+            choice = choices[-1]
+            mark = choice[5]
+            if len(trail) > mark:
+                for a in trail[mark:]:
+                    heap[a] = (_REF, a)
+                del trail[mark:]
+            del heap[choice[6]:]
+            HB = choice[6]
+            code, pc, saved, E, CP = choice[:5]
+            B0 = choice[7]
+            solutions = choice[8]
+            if solutions is None:
+                A[:len(saved)] = saved
+                break
+            for s in solutions:
+                if _wam_answer(heap, trail, HB, s, choice[9]):
+                    break
+            else:
+                choices.pop()
+                continue
+            break
+        else:
+            return
+
+def _wam_solve(proc, args, s):
+    # solutions of the call of proc with the terms args
+    heap = []
+    varmap = {}
+    addresses = [_wam_encode(heap, a, s, varmap) for a in args]
+    inputs = varmap.values()
+    for _ in _wam_run(proc, heap, addresses):
+        memo = {}
+        for v, a in inputs:
+            a = _wam_deref(heap, a)
+            if heap[a][0] == _REF and a not in memo:
+                memo[a] = v
+        s1 = s
+        for v, a in inputs:
+            t = _wam_decode(heap, a, memo)
+            if t is not v:
+                for s1 in s1.unify(v, t):
+                    break
+        yield s1
+
+class Wam(Term1):
+    """ Wam(+Goal)
+    Solves Goal on the bytecode machine: Goal and the clauses of the predicates it calls are compiled into instructions in the style of the Warren Abstract Machine (get, put, unify, call, execute, try, retry, trust...) run by a single loop over a heap of cells. The terms of the goal are copied to the heap and the solutions are returned as bindings of its variables, as the other engines do. Goals other than predicates, conjunctions, disjunctions, if-then-else, negation, cut and Unify are called as usual with the terms of their arguments.
+
+    The heap is only reclaimed by backtracking.
+    """
+
+    def __call__(self, s):
+        goal = s[self.args[0]]
+        vs = _term_vars((goal,))
+        proc = _WamProc('query', clauses=[(vs, goal)])
+        return _wam_solve(proc, vs, s)
 
 """
 
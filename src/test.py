@@ -22,6 +22,150 @@ test = {
         s2 = s1.unify(X, Y).next()
         print "Y:", Y, "; s2(Y):", s2(Y)
     """,
+    'trail': """
+        X = Var('X')
+        goal = (Unify(X, 1) | Unify(X, 2)) & IsInteger(X)
+        print [s(X) for s in goal(TrailStack())]
+        s = goal(TrailStack()).next(); store = weakref.ref(s.store); del s
+        print X.store() is store() is None
+    """,
+    'sort': """
+        S = Var('S')
+        xs = cons(3, cons('b', cons(1.0, cons('a', cons(3, nil)))))
+        print [str(s(S)) for s in Sort(xs, S)(Stack())]
+        print [str(s(S)) for s in Sort(0, Ge, xs, S)(Stack())]
+        X = Var('X'); s = Stack().unify(X, cons(X, nil)).next()
+        for s1 in Sort(to_term([pair(X, 2), 'a', X, pair(X, 2), X]), S)(s): write_term(S, sys.stdout, s1); print
+        for s1 in KeySort(to_term([pair(X, 'x'), pair(0, 'y')]), S)(s): write_term(S, sys.stdout, s1); print
+    """,
+    'convert': """
+        X = Var('X')
+        t = to_term([1, ('a', X), {'k': [2.5]}])
+        print t
+        s = Stack().unify(X, to_term([3])).next()
+        print from_term(t, s)
+        d = {(1, (2, 3)): 'a', 'b': [3]}
+        print dict(from_term(to_term(d))) == d
+    """,
+    'cyclic': """
+        X = Var('X')
+        s = Stack().unify(X, plist([1, 2], X)).next()
+        t = s(X)
+        print t._hash, len(list(Unify(t, t)(Stack()))), len(list(Eq(t, t)(Stack())))
+        write_term(t, sys.stdout, max_length=5); print
+    """,
+    'hashcons': """
+        class f(Term): pass
+        a, b = hashcons(f, 1, 'x'), hashcons(f, 1, 'x')
+        print a is b, is_canonical(a), is_canonical(f(1, 'x'))
+        print hashcons(f, 1.0), hashcons(f, 1), hashcons(f, True), hashcons(f, u'a'), hashcons(f, 'a')
+        print hashcons(f, 1.0) is hashcons(f, 1), [type(hashcons(f, x).args[0]).__name__ for x in (1, 1.0, True)]
+        t = canonical(f(f(1, 'x'), f(1, 'x')))
+        print t.args[0] is t.args[1] is a, len(list(Eq(hashcons(f, 1), hashcons(f, 1.0))(Stack())))
+        d = {GroundKey(f(1, 'x')): 'a', GroundKey(to_term([1, 2])): 'b'}
+        print d.get(GroundKey(f(1, 'x'))), d.get(GroundKey(f(1.0, 'x'))), d.get(GroundKey(cons(1, cons(2, nil))))
+    """,
+    'predicates': """
+        class indian(Predicate): pass
+        class mild(Predicate): pass
+        class likes(Predicate): pass
+        for food in ['curry', 'dahl', 'kurma']: indian.assertz(indian(food))
+        for food in ['dahl', 'kurma']: mild.assertz(mild(food))
+        Food = Var('Food')
+        likes.assertz(likes('sam', Food), indian(Food) & mild(Food))
+        likes.assertz(likes('sam', 'chips'))
+        X = Var('X')
+        print [s(X) for s in likes('sam', X)(Stack())]
+        print [s(X) for s in (indian('dahl') & likes(X, 'dahl'))(Stack())]
+        print [s(X) for s in (indian(X) & Rec(lambda: indian.asserta(indian(X)) or true))(Stack())], len(list(indian(X)(Stack())))
+    """,
+    'indexing': """
+        class sq(Predicate): pass
+        class label(Predicate): pass
+        class point(Term): pass
+        X, Y = Var('X'), Var('Y')
+        for i in range(5): sq.assertz(sq(i, i*i))
+        for i in range(4): label.assertz(label(point(i % 2, i), i))
+        print [s(X) for s in sq(X, 9)(Stack())], [(s(X), s(Y)) for s in label(point(X, 3), Y)(Stack())]
+        sq.asserta(sq(-3, 9)); sq.assertz(sq(X, 9)); label.asserta(label(point(1, 3), 'a'))
+        print [str(s(X)) for s in sq(X, 9)(Stack())], [s(Y) for s in label(point(1, 3), Y)(Stack())], [s(Y) for s in sq(4, Y)(Stack())]
+        for stats in sq.index_stats() + label.index_stats(): print sorted(stats.items())
+    """,
+    'solve': """
+        class app(Predicate): pass
+        H, T, L, L2, R = Var('H'), Var('T'), Var('L'), Var('L2'), Var('R')
+        app.assertz(app(nil, L, L))
+        app.assertz(app(cons(H, T), L2, cons(H, R)), app(T, L2, R))
+        A, B = Var('A'), Var('B')
+        print [(from_term(A, s), from_term(B, s)) for s in Solve(app(A, B, to_term([1, 2])))(Stack())]
+        print from_term(A, Solve(app(to_term(range(10000)), to_term([0]), A))(Stack()).next())[-2:]
+    """,
+    'cut': """
+        def compiled(g): Predicate.compiled = True; ss = list(compile_goal(g)(Stack())); Predicate.compiled = False; return ss
+        engines = [lambda g: list(g(Stack())), lambda g: list(Solve(g)(Stack())), compiled, lambda g: list(Wam(g)(Stack()))]
+        def check(g, *vs): r = [[tuple([s(v) for v in vs]) for s in e(g)] for e in engines]; print r[0], r.count(r[0]) == len(r)
+        class m(Predicate): pass
+        class disj(Predicate): pass
+        class ite(Predicate): pass
+        class neg(Predicate): pass
+        class mchk(Predicate): pass
+        X, Y, T = Var('X'), Var('Y'), Var('T')
+        for i in (1, 2, 3): m.assertz(m(i))
+        disj.assertz(disj(X), Unify(X, 0) | (m(X) & cut) | Unify(X, 9))
+        disj.assertz(disj(4))
+        ite.assertz(ite(X, Y), IfThenElse(m(X), cut & m(Y), Unify(Y, 'e')))
+        ite.assertz(ite(0, 'z'))
+        neg.assertz(neg(X), m(X) & Not(Unify(X, 2) & cut))
+        neg.assertz(neg(4))
+        mchk.assertz(mchk(X, cons(X, T)), cut)
+        mchk.assertz(mchk(X, cons(Y, T)), mchk(X, T))
+        check(disj(X), X)
+        check(ite(X, Y), X, Y)
+        check(neg(X), X)
+        check(mchk(X, to_term([1, 2, 3])), X)
+        check(mchk(2, to_term([1, 2, 2, 3])) & m(X), X)
+        class c(Predicate): pass
+        c.assertz(c(1), IfThenElse(cut, true, cut)); c.assertz(c(2))
+        check(c(X), X)
+    """,
+    'compile': """
+        class edge(Predicate): pass
+        class path(Predicate): pass
+        X, Y, Z = Var('X'), Var('Y'), Var('Z')
+        for a, b in [(1, 2), (2, 3), (3, 4)]: edge.assertz(edge(a, b))
+        path.assertz(path(X, Y), edge(X, Y))
+        path.assertz(path(X, Y), edge(X, Z) & path(Z, Y))
+        path.compiled = True
+        print [s(Y) for s in compile_goal(path(1, Y) & Gt(Y, 2))(Stack())]
+        class big(Predicate): pass
+        big.assertz(big(plist([Var() for i in xrange(10**5)], X), X))
+        big.compiled = True
+        print [s(Y) for s in compile_goal(big(Z, Y) & Unify(Y, 1))(Stack())]
+    """,
+    'wam': """
+        class app(Predicate): pass
+        H, T, L, L2, R = Var('H'), Var('T'), Var('L'), Var('L2'), Var('R')
+        app.assertz(app(nil, L, L))
+        app.assertz(app(cons(H, T), L2, cons(H, R)), app(T, L2, R))
+        A, B = Var('A'), Var('B')
+        print [(from_term(A, s), from_term(B, s)) for s in Wam(app(A, B, to_term([1, 2])))(Stack())]
+        app.wam = True
+        print [from_term(B, s) for s in (app(to_term([1]), A, B) & Unify(A, to_term([2, 3])))(Stack())]
+        class plus2(Predicate): pass
+        N, N1 = Var('N'), Var('N1')
+        plus2.assertz(plus2(N, R), Succ(N, N1) & Succ(N1, R))
+        print [s(R) for s in Wam(plus2(3, R))(Stack())]
+        print len(from_term(A, Wam(Unify(A, plist([Var() for i in xrange(10**5)])))(Stack()).next()))
+    """,
+    'write': """
+        X, T = Var('X'), Var('T')
+        s = Stack().unify(X, cons(X, T)).next()
+        write_term(to_term([1, 'Hello', {'k': 2.5}, X]), sys.stdout, s); print
+        write_term(to_term(range(100)), sys.stdout, max_length=5); print
+        write_term(to_term([range(3), 'a']), sys.stdout, max_length=0); print
+        write_term(to_term([pair(1, pair(2, 3)), pair(pair(1, 2), 3), pair(-1, -2.5), pair(X, Var('X'))]), sys.stdout); print
+        s = Stack().unify(X, pair(X, 1)).next(); write_term(X, sys.stdout, s); print
+    """,
 }
 
 if __name__ == '__main__':